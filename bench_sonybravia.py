@@ -0,0 +1,385 @@
+#!/usr/bin/python3
+
+# Benchmarks for the adapter hot paths, run against stub_bravia instead of a real TV.
+# Each scenario reports p50/p99 latency and throughput so regressions show up as a change in the numbers.
+#
+#   python3 bench_sonybravia.py --latency 0.03 --iterations 50 --tvs 50
+#   python3 bench_sonybravia.py --scenario single --record traffic.json.gz
+
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
+import asyncio
+import logging
+import argparse
+import json
+import time
+import tempfile
+import tracemalloc
+import gc
+from types import SimpleNamespace
+
+import aiohttp
+from sonybravia import sonybravia, BroadcastProtocol, sony_notifications
+from stub_bravia import stub_bravia
+
+
+class benchConfig(sonybravia.adapter_config):
+
+    # Reads the adapter fields from a plain dict instead of the adapter's config file
+
+    def __init__(self, values):
+        self.values=values
+        self.adapter_fields()
+
+    def set_or_default(self, name, default=None, mandatory=False):
+        if name in self.values:
+            return self.values[name]
+        if mandatory:
+            raise KeyError(name)
+        return default
+
+
+class benchDataset():
+
+    # Just enough of the sofabase dataset for the adapter: nested nativeDevices updated in place
+
+    def __init__(self):
+        self.nativeDevices={}
+        self.localDevices={}
+        self.ingests=0
+
+    async def ingest(self, data, mergeReplace=False):
+        self.ingests+=1
+        for device_type in data:
+            if device_type not in self.nativeDevices:
+                self.nativeDevices[device_type]={}
+            for device_id in data[device_type]:
+                if device_id not in self.nativeDevices[device_type]:
+                    self.nativeDevices[device_type][device_id]={}
+                self.nativeDevices[device_type][device_id].update(data[device_type][device_id])
+
+    async def generateResponse(self, endpointId, correlationToken):
+        return { 'event': { 'endpoint': { 'endpointId': endpointId }, 'correlationToken': correlationToken } }
+
+    def add_device(self, device):
+        self.localDevices[device.endpointId]=device
+        return device
+
+
+def percentile(samples, pct):
+    if not samples:
+        return 0
+    ordered=sorted(samples)
+    return ordered[min(len(ordered)-1, int(round(pct/100*(len(ordered)-1))))]
+
+def report(name, samples, elapsed, extra=''):
+    result={ 'scenario': name, 'count': len(samples), 'p50_ms': percentile(samples, 50)*1000, 'p99_ms': percentile(samples, 99)*1000,
+                'per_second': len(samples)/elapsed if elapsed else 0, 'extra': extra }
+    print('%-38s n=%-5s p50=%8.2fms  p99=%8.2fms  %9.1f/s  %s' % (name, result['count'], result['p50_ms'], result['p99_ms'], result['per_second'], extra))
+    return result
+
+def requestsPer(stub, iterations):
+    start=stub.requests+stub.ircc_requests
+    return lambda: 'tv requests per call %.1f' % ((stub.requests+stub.ircc_requests-start)/iterations)
+
+async def timed(name, iterations, coro_factory, extra=None):
+    samples=[]
+    start=time.perf_counter()
+    for i in range(iterations):
+        began=time.perf_counter()
+        await coro_factory(i)
+        samples.append(time.perf_counter()-began)
+    elapsed=time.perf_counter()-start
+    return report(name, samples, elapsed, extra() if extra else '')
+
+
+async def makeAdapter(stubs, log, settings={}):
+    values={ 'tvs': [{ 'address': stub.host, 'port': stub.port, 'preshared_key': '0000', 'name': stub.name, 'hdmi_port_names': { '1': 'Cable', '2': 'Game' } } for stub in stubs],
+                'refresh_debounce': 0, 'snapshot_cache': '', 'tv_rate_limit': 0 }
+    values.update(settings)
+    adapter=sonybravia.adapterProcess(log=log, dataset=benchDataset(), config=benchConfig(values), loop=asyncio.get_event_loop())
+    connector=aiohttp.TCPConnector(limit=adapter.config.tv_connection_pool_limit, limit_per_host=adapter.config.tv_connection_limit, keepalive_timeout=adapter.config.tv_keepalive)
+    adapter.session=aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=adapter.config.tv_request_timeout))
+    adapter.notification_session=aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=len(sony_notifications.services)))
+    adapter.loadStaticCache()
+    if adapter.config.record_traffic:
+        adapter.startRecording(adapter.config.record_traffic)
+    await asyncio.gather(*[adapter.addTV(entry) for entry in adapter.config.tvs])
+    return adapter
+
+def controller(adapter, tv, name='', supportedModes={}):
+
+    # Controller directives only touch these attributes, so they can be driven without the sofabase device classes
+    device=SimpleNamespace(endpointId='sonybravia:tv:%s' % tv.name, adapter=adapter)
+    return SimpleNamespace(adapter=adapter, device=device, log=adapter.log, name=name, _supportedModes=supportedModes,
+                            nativeObject=adapter.dataset.nativeDevices['tv'][tv.name])
+
+
+async def benchSingle(args, log, results):
+
+    stub=await stub_bravia(latency=args.latency, jitter=args.jitter, apps=args.apps).start()
+    adapter=await makeAdapter([stub], log, { 'record_traffic': args.record } if args.record else {})
+    tv=list(adapter.tvs.values())[0]
+    try:
+        results.append(await timed('getUpdate', args.iterations, lambda i: adapter.getUpdate(tv), requestsPer(stub, args.iterations)))
+        results.append(await timed('getInitialData', args.iterations, lambda i: adapter.getInitialData(tv), requestsPer(stub, args.iterations)))
+
+        # time until the TV is registered at adapter startup, without and then with the static snapshot cache
+        cachefile=os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        async def startup(i, cached):
+            if not cached and os.path.exists(cachefile):
+                os.remove(cachefile)
+            started=await makeAdapter([stub], log, { 'snapshot_cache': cachefile, 'notifications': False })
+            await started.stop()
+        results.append(await timed('startup (cold)', args.iterations, lambda i: startup(i, False), requestsPer(stub, args.iterations)))
+        await startup(0, False)
+        results.append(await timed('startup (cached)', args.iterations, lambda i: startup(i, True)))
+
+        # time from an M-SEARCH until a new set is registered, each answered by a stub on its own loopback address
+        found=[]
+        async def discovered(i):
+            newtv=await stub_bravia(host='127.0.1.%s' % (i%250+1), name='FOUND%s' % i, latency=args.latency).start()
+            found.append(newtv)
+            searching=asyncio.ensure_future(adapter.discoverTVs(target=(newtv.host, await newtv.answerSearches())))
+            while newtv.name not in adapter.tvs and not searching.done():
+                await asyncio.sleep(0.001)
+            searching.cancel()
+        try:
+            results.append(await timed('discovery', min(args.iterations, 250), discovered))
+        finally:
+            for newtv in found:
+                if newtv.name in adapter.tvs:
+                    extra=adapter.tvs.pop(newtv.name)
+                    adapter.tv_addresses.pop(newtv.host, None)
+                    await adapter.closeTV(extra)
+                await newtv.stop()
+
+        power=controller(adapter, tv)
+        speaker=controller(adapter, tv)
+        audio=controller(adapter, tv, 'Audio', {'speaker': 'TV', "audioSystem": 'Receiver'})
+        saving=controller(adapter, tv, 'PowerSaving', {'off': 'Off', "low": "Low"})
+        inputs=controller(adapter, tv)
+        remote=controller(adapter, tv)
+        directives=[    ('PowerController.TurnOn', lambda i: sonybravia.PowerController.TurnOn(power)),
+                        ('SpeakerController.SetVolume', lambda i: sonybravia.SpeakerController.SetVolume(speaker, {'volume': 10+i%50})),
+                        ('AudioModeController.SetMode', lambda i: sonybravia.AudioModeController.SetMode(audio, {'mode': 'Audio.speaker'})),
+                        ('PowerSavingModeController.SetMode', lambda i: sonybravia.PowerSavingModeController.SetMode(saving, {'mode': 'PowerSaving.%s' % ['off', 'low'][i%2]})),
+                        ('InputController.SelectInput', lambda i: sonybravia.InputController.SelectInput(inputs, {'input': ['Cable', 'Game'][i%2]})),
+                        ('RemoteController.PressRemoteButton', lambda i: sonybravia.RemoteController.PressRemoteButton(remote, {'buttonName': 'VolumeUp'})),
+                        ('PowerController.TurnOff', lambda i: sonybravia.PowerController.TurnOff(power)) ]
+        for name, directive in directives:
+            results.append(await timed(name, args.iterations, directive, requestsPer(stub, args.iterations)))
+
+        # the ticker measures how late the event loop runs a 10ms sleep while IRCC presses are in flight, so a send
+        # that blocked the loop would show up as lag of about the stub latency and as missing ticks
+        lag=[]
+        async def ticker():
+            while True:
+                began=time.perf_counter()
+                await asyncio.sleep(0.01)
+                lag.append(time.perf_counter()-began-0.01)
+        code=adapter.findRemoteCode(tv, 'VolumeUp')
+        ticking=asyncio.ensure_future(ticker())
+        try:
+            results.append(await timed('remoteControl', args.iterations, lambda i: tv.rest.remoteControl(code),
+                                        lambda: 'ticks %s  loop lag p99 %.2fms' % (len(lag), percentile(lag, 99)*1000)))
+        finally:
+            ticking.cancel()
+
+        # TurnOn of a set in standby that takes half a second to wake, until the adapter reports it ready and refreshed
+        waking=await stub_bravia(latency=args.latency, jitter=args.jitter, apps=args.apps, wake_time=0.5).start()
+        woken=await makeAdapter([waking], log, { 'notifications': False })
+        wokentv=list(woken.tvs.values())[0]
+        wokenpower=controller(woken, wokentv)
+        async def wake(i):
+            await sonybravia.PowerController.TurnOff(wokenpower)
+            began=time.perf_counter()
+            await sonybravia.PowerController.TurnOn(wokenpower)
+            return time.perf_counter()-began
+        try:
+            samples=[await wake(i) for i in range(min(args.iterations, 5))]
+            results.append(report('PowerController.TurnOn (wake 500ms)', samples, sum(samples),
+                                    'time to ready avg %sms' % wokentv.rest.metrics.dump()['time_to_ready']['avg_ms']))
+        finally:
+            await woken.stop()
+            await waking.stop()
+
+        # a held volume key and fast button taps: a burst of directives issued together and waited on as one
+        await sonybravia.PowerController.TurnOn(power)
+        results.append(await timed('SetVolume burst x%s' % args.burst, args.iterations,
+                                    lambda i: asyncio.gather(*[sonybravia.SpeakerController.SetVolume(speaker, {'volume': 10+n%50}) for n in range(args.burst)]),
+                                    requestsPer(stub, args.iterations)))
+        results.append(await timed('PressRemoteButton burst x%s' % args.burst, args.iterations,
+                                    lambda i: asyncio.gather(*[sonybravia.RemoteController.PressRemoteButton(remote, {'buttonName': 'VolumeUp'}) for n in range(args.burst)]),
+                                    requestsPer(stub, args.iterations)))
+
+        # directive latency while background reads keep a 20 request/s rate limiter saturated, with the reads in
+        # the poll lane and then in the refresh lane SSDP and startup refreshes use
+        limited=await makeAdapter([stub], log, { 'tv_rate_limit': 20, 'notifications': False })
+        limitedtv=list(limited.tvs.values())[0]
+        limitedspeaker=controller(limited, limitedtv)
+        polled=[('audio', 'getVolumeInformation', '1.0', []), ('avContent', 'getPlayingContentInfo', '1.0', [])]
+        async def loaded(lane):
+            async def background():
+                while True:
+                    await limitedtv.rest.getBatch(polled, priority=lane)
+            loops=[asyncio.ensure_future(background()) for n in range(args.burst)]
+            try:
+                await asyncio.sleep(0.1)
+                return await timed('SetVolume under load (%s lane)' % lane, min(args.iterations, 5),
+                                    lambda i: sonybravia.SpeakerController.SetVolume(limitedspeaker, {'volume': 10+i%50}),
+                                    lambda: 'limiter queue max %s' % limitedtv.rest.metrics.queue_depth_max)
+            finally:
+                for loop in loops:
+                    loop.cancel()
+                await asyncio.gather(*loops, return_exceptions=True)
+        try:
+            for lane in ['poll', 'refresh']:
+                results.append(await loaded(lane))
+        finally:
+            await limited.stop()
+
+        # change-to-dataset latency over the notification socket, from a volume change on the TV side
+        for i in range(100):
+            if tv.notifications and tv.notifications.pushed('VolumeInformation'):
+                break
+            await asyncio.sleep(0.01)
+        async def pushed(i):
+            volume=60+i%30
+            stub.answer('audio', { 'id': 1, 'method': 'setAudioVolume', 'params': [{ 'volume': str(volume), 'target': 'speaker' }] })
+            while adapter.snapshot[tv.name]['VolumeInformation'][0]['volume']!=volume:
+                await asyncio.sleep(0.0005)
+        if tv.notifications and tv.notifications.pushed('VolumeInformation'):
+            results.append(await timed('push VolumeInformation', args.iterations, pushed))
+
+        # SSDP bursts: replay NOTIFY packets into the protocol and wait for the refreshes they trigger
+        protocol=BroadcastProtocol(adapter.loop, log, adapter.config.ssdpkeywords, returnmessage=adapter.processUPNP, recorder=adapter.recorder)
+        packet=stub.notify()
+        async def burst(i):
+            for n in range(args.burst):
+                protocol.datagram_received(packet, (stub.host, 1900))
+            await asyncio.sleep(0)
+            while tv.pending_update is not None or tv.active_update is not None:
+                await asyncio.sleep(0.001)
+        results.append(await timed('ssdp burst x%s' % args.burst, args.iterations, burst, requestsPer(stub, args.iterations)))
+
+        # traffic from other UPnP devices on the LAN, which should be dropped without any work
+        foreign=stub_bravia(host='192.0.2.1', port=49152).notify().replace(b'BRAVIA', b'Linux')
+        samples=[]
+        start=time.perf_counter()
+        for i in range(args.iterations*args.burst):
+            began=time.perf_counter()
+            protocol.datagram_received(foreign, ('192.0.2.1', 1900))
+            samples.append(time.perf_counter()-began)
+        results.append(report('datagram_received (foreign)', samples, time.perf_counter()-start))
+
+        # replayed mixed LAN traffic through a protocol that only counts what it would refresh
+        async def counted(event, addr):
+            counted.events+=1
+        counted.events=0
+        filtered=BroadcastProtocol(adapter.loop, log, adapter.config.ssdpkeywords, returnmessage=counted, addresses={ '192.0.2.50': tv })
+        msearch=b'M-SEARCH * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nMAN: "ssdp:discover"\r\nMX: 1\r\nST: ssdp:all\r\n\r\n'
+        known=stub_bravia(host='192.0.2.50', port=49153).notify()
+        traffic=[(foreign, ('192.0.2.1', 1900)), (msearch, ('192.0.2.2', 50000)), (foreign.replace(b'upnp:rootdevice', b'urn:schemas-upnp-org:device:MediaRenderer:1'), ('192.0.2.3', 1900)),
+                    (known, ('192.0.2.50', 1900))]*(args.iterations*args.burst//4)
+        start=time.perf_counter()
+        for data, addr in traffic:
+            filtered.datagram_received(data, addr)
+        elapsed=time.perf_counter()-start
+        await asyncio.sleep(0)
+        results.append(report('datagram_received (mixed replay)', [elapsed/len(traffic)]*len(traffic), elapsed, 'refreshes scheduled %s of %s' % (counted.events, len(traffic))))
+    finally:
+        await adapter.stop()
+        await stub.stop()
+
+
+async def benchMulti(args, log, results):
+
+    stubs=[await stub_bravia(name='BRAVIA%s' % i, latency=args.latency, jitter=args.jitter, apps=args.apps).start() for i in range(args.tvs)]
+    adapter=await makeAdapter(stubs, log)
+    tvs=list(adapter.tvs.values())
+
+    # the ticker measures how late the event loop runs a 10ms sleep while the refreshes are in flight
+    lag=[]
+    async def ticker():
+        while True:
+            began=time.perf_counter()
+            await asyncio.sleep(0.01)
+            lag.append(time.perf_counter()-began-0.01)
+    ticking=asyncio.ensure_future(ticker())
+    try:
+        for count in sorted(set([1, max(1, args.tvs//10), args.tvs])):
+            subset=tvs[:count]
+            lag.clear()
+            began=time.perf_counter()
+            samples=[]
+            for i in range(args.iterations):
+                started=time.perf_counter()
+                await asyncio.gather(*[adapter.getUpdate(tv) for tv in subset])
+                samples.append(time.perf_counter()-started)
+            elapsed=time.perf_counter()-began
+            result=report('getUpdate x%s tvs' % count, samples, elapsed, '%.1f refreshes/s  loop lag p99 %.2fms' % (count*args.iterations/elapsed, percentile(lag, 99)*1000))
+            result['refreshes_per_second']=count*args.iterations/elapsed
+            results.append(result)
+    finally:
+        ticking.cancel()
+        await adapter.stop()
+        for stub in stubs:
+            await stub.stop()
+
+
+async def benchMemory(args, log, results):
+
+    # Python heap traced while the adapter starts against args.tvs stub TVs.  The stubs are created first so their own
+    # data is not counted, but the buffers they build for each response are part of the peak.
+    stubs=[await stub_bravia(name='BRAVIA%s' % i, latency=args.latency, apps=args.apps).start() for i in range(args.tvs)]
+    adapter=None
+    try:
+        gc.collect()
+        tracemalloc.start()
+        baseline=tracemalloc.get_traced_memory()[0]
+        adapter=await makeAdapter(stubs, log, { 'notifications': False })
+        peak=tracemalloc.get_traced_memory()[1]-baseline
+        gc.collect()
+        retained=tracemalloc.get_traced_memory()[0]-baseline
+        tracemalloc.stop()
+        result={ 'scenario': 'memory x%s tvs' % args.tvs, 'count': args.tvs, 'peak_kb_per_tv': peak/1024/args.tvs, 'retained_kb_per_tv': retained/1024/args.tvs }
+        print('%-38s n=%-5s peak %8.1fKB/tv  retained %8.1fKB/tv  (%s apps each)' % (result['scenario'], args.tvs, result['peak_kb_per_tv'], result['retained_kb_per_tv'], args.apps))
+        results.append(result)
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        if adapter:
+            await adapter.stop()
+        for stub in stubs:
+            await stub.stop()
+
+
+async def main(args):
+    log=logging.getLogger('bench')
+    logging.basicConfig(level=logging.WARNING if not args.verbose else logging.INFO)
+    results=[]
+    if args.scenario in ['all', 'single']:
+        await benchSingle(args, log, results)
+    if args.scenario in ['all', 'multi']:
+        await benchMulti(args, log, results)
+    if args.scenario in ['all', 'memory']:
+        await benchMemory(args, log, results)
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Benchmark the sonybravia adapter against stub TVs')
+    parser.add_argument('--scenario', default='all', choices=['all', 'single', 'multi', 'memory'])
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02, help='stub TV response latency in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--tvs', type=int, default=50, help='number of stub TVs for the multi TV and memory scenarios')
+    parser.add_argument('--burst', type=int, default=20, help='SSDP packets per burst')
+    parser.add_argument('--apps', type=int, default=200, help='applications each stub TV reports')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--record', help='record the single TV scenario traffic to this file for replay_sonybravia.py')
+    parser.add_argument('--verbose', action='store_true')
+    asyncio.run(main(parser.parse_args()))
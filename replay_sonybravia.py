@@ -0,0 +1,368 @@
+#!/usr/bin/python3
+
+# Replays a traffic log written with the record_traffic setting through the adapter with no network, so getStates,
+# datagram_received and the controller paths can be timed and profiled against what a real set answered.
+# Each request is answered with what the TV said to the same method at that point of the recording, SSDP datagrams
+# go to the protocol, recorded poll refreshes are run again and recorded set calls are replayed as the directives
+# that send them.  --speed 0 replays as fast as possible without the recorded latencies.
+#
+#   python3 replay_sonybravia.py traffic.json.gz --speed 10 --profile replay.prof
+
+import sys, os
+sys.path.append(os.path.dirname(__file__))
+
+import asyncio
+import logging
+import argparse
+import gzip
+import json
+import time
+import bisect
+import cProfile
+import pstats
+import urllib.parse
+from types import SimpleNamespace
+
+import aiohttp
+from sonybravia import sonybravia, BroadcastProtocol
+from bench_sonybravia import benchConfig, benchDataset, controller, report
+
+
+class replay_log():
+
+    # The recorded answers are indexed by "address:port" and service plus method and params, by method alone for calls
+    # whose params changed, and per service for batch support.  Each index is a time ordered list of
+    # (time, latency, answer) where answer is ('json', result), ('raw', status, body), ('fail', kind) or, for a
+    # batch marker, None when batches worked.
+
+    def __init__(self, path):
+        self.answers={}
+        self.times={}
+        self.events=[]
+        self.truncated=False
+        with gzip.open(path, 'rt', encoding='utf-8') as source:
+            self.header=json.loads(source.readline())
+            try:
+                for line in source:
+                    record=json.loads(line)
+                    if record[1] in ('http', 'fail'):
+                        self.index(record)
+                    elif record[1] in ('tv', 'ssdp', 'update'):
+                        self.events.append(record)
+            except (EOFError, ValueError):
+                # the log of an adapter that was killed ends mid stream, and maybe mid line, after its last flush
+                self.truncated=True
+        for key in self.answers:
+            self.answers[key].sort(key=lambda entry: entry[0])
+            self.times[key]=[entry[0] for entry in self.answers[key]]
+        self.events.sort(key=lambda event: event[0])
+
+    def add(self, key, at, latency, answer):
+        if key not in self.answers:
+            self.answers[key]=[]
+        self.answers[key].append((at, latency, answer))
+
+    def index(self, record):
+        at, kind, address, path, request, latency=record[:6]
+        answer=('fail', record[6]) if kind=='fail' else ('raw', record[6], record[7])
+        if path=='sony/IRCC':
+            self.add((address, 'IRCC'), at, latency, answer)
+            code=request.partition('<IRCCCode>')[2].partition('</IRCCCode>')[0]
+            self.events.append([at, 'ircc', address, code])
+            return
+        section=path.split('/', 1)[1]
+        commands=json.loads(request)
+        batch=isinstance(commands, list)
+        results=None
+        if kind=='http':
+            try:
+                results=json.loads(record[7])
+            except ValueError:
+                pass
+        if batch:
+            # firmware without batch support answers a batch with a single error object
+            self.add((address, section, 'batch'), at, latency, answer if kind=='http' and not isinstance(results, list) else None)
+            if kind=='http' and not isinstance(results, list):
+                return
+        byid={}
+        for result in (results if isinstance(results, list) else [results]):
+            if isinstance(result, dict):
+                byid[result.get('id')]=result
+        for command in (commands if batch else [commands]):
+            if kind=='fail':
+                subanswer=answer
+            elif command['id'] in byid:
+                subanswer=('json', { key: value for key, value in byid[command['id']].items() if key!='id' })
+            elif not batch:
+                subanswer=answer
+            else:
+                continue
+            self.add((address, section, command['method'], json.dumps(command.get('params'), sort_keys=True)), at, latency, subanswer)
+            self.add((address, section, command['method']), at, latency, subanswer)
+            if command['method'].startswith('set'):
+                self.events.append([at, 'set', address, section, command['method'], command.get('params')])
+
+    def lookup(self, key, at):
+        # the last answer recorded at or before at, or the first one when the replay is earlier than any
+        if key not in self.answers:
+            return None
+        return self.answers[key][max(0, bisect.bisect_right(self.times[key], at)-1)]
+
+
+class replay_session():
+
+    # Takes the place of the adapter's aiohttp session: post() answers from the log after the recorded latency
+
+    def __init__(self, recording, clock, speed=1.0):
+        self.recording=recording
+        self.clock=clock
+        self.speed=speed
+        self.closed=False
+        self.requests=0
+        self.unanswered=0
+
+    def post(self, url, data=None, headers=None, timeout=None):
+        return replay_response(self, url, data)
+
+    async def close(self):
+        self.closed=True
+
+    async def answer(self, url, data):
+
+        self.requests+=1
+        address=urllib.parse.urlparse(url).netloc
+        path=urllib.parse.urlparse(url).path.lstrip('/')
+        now=self.clock()
+        if isinstance(data, bytes):
+            data=data.decode('latin-1')
+        if path=='sony/IRCC':
+            found=self.recording.lookup((address, 'IRCC'), now)
+            if not found:
+                self.unanswered+=1
+                return await self.respond(0, ('raw', 200, ''))
+            return await self.respond(found[1], found[2])
+
+        section=path.split('/', 1)[1]
+        commands=json.loads(data)
+        batch=isinstance(commands, list)
+        if batch:
+            marker=self.recording.lookup((address, section, 'batch'), now)
+            if marker and marker[2] is not None:
+                return await self.respond(marker[1], marker[2])
+        latency=0
+        results=[]
+        for command in (commands if batch else [commands]):
+            found=self.recording.lookup((address, section, command['method'], json.dumps(command.get('params'), sort_keys=True)), now) or \
+                    self.recording.lookup((address, section, command['method']), now)
+            if not found:
+                self.unanswered+=1
+                results.append({ 'id': command['id'], 'error': [12, 'Not in recording'] })
+                continue
+            latency=max(latency, found[1])
+            if found[2][0]!='json':
+                return await self.respond(latency, found[2])
+            results.append(dict(found[2][1], id=command['id']))
+        return await self.respond(latency, ('json', results if batch else results[0]))
+
+    async def respond(self, latency, answer):
+        if self.speed:
+            await asyncio.sleep(latency/self.speed)
+        if answer[0]=='fail':
+            if answer[1]=='timeouts':
+                raise asyncio.TimeoutError()
+            raise aiohttp.client_exceptions.ClientConnectorError(SimpleNamespace(host='replay', port=0, ssl=True), OSError(111, 'Connection refused'))
+        if answer[0]=='raw':
+            return answer[1], answer[2].encode('latin-1')
+        return 200, json.dumps(answer[1]).encode()
+
+
+class replay_response():
+
+    def __init__(self, session, url, data):
+        self.session=session
+        self.url=url
+        self.data=data
+        self.status=None
+        self.body=b''
+
+    async def __aenter__(self):
+        self.status, self.body=await self.session.answer(self.url, self.data)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def read(self):
+        return self.body
+
+
+class replay_driver():
+
+    scaled_settings=('refresh_debounce', 'circuit_cooldown', 'wake_poll_interval', 'wake_poll_max', 'wake_timeout')
+
+    def __init__(self, args, log):
+        self.args=args
+        self.log=log
+        self.loop=asyncio.get_event_loop()
+        self.recording=replay_log(args.log)
+        self.samples={}
+        self.tasks=[]
+        self.cursor=self.recording.events[0][0] if self.recording.events else 0
+        self.base=None
+
+    def clock(self):
+        # the point of the recording the replay has reached
+        if not self.args.speed or self.base is None:
+            return self.cursor
+        return self.recording.events[0][0]+(self.loop.time()-self.base)*self.args.speed
+
+    def makeAdapter(self):
+        # The recorded settings are used with their times scaled to the replay speed, and --config goes over them
+        values={ 'tvs': [], 'notifications': False, 'snapshot_cache': '', 'discovery': False }
+        values.update(self.recording.header.get('settings', {}))
+        for name in self.scaled_settings:
+            if name in values:
+                values[name]=values[name]/self.args.speed if self.args.speed else 0
+        values['tv_rate_limit']=values.get('tv_rate_limit', 0)*self.args.speed
+        if self.args.config:
+            values.update(json.loads(self.args.config))
+        adapter=sonybravia.adapterProcess(log=self.log, dataset=benchDataset(), config=benchConfig(values), loop=self.loop)
+        adapter.session=replay_session(self.recording, self.clock, self.args.speed)
+        states=adapter.getStates
+        async def timedStates(tv, systemdata, priority='refresh'):
+            began=time.perf_counter()
+            try:
+                return await states(tv, systemdata, priority=priority)
+            finally:
+                self.sample('getStates', time.perf_counter()-began)
+        adapter.getStates=timedStates
+        return adapter
+
+    def sample(self, name, seconds):
+        if name not in self.samples:
+            self.samples[name]=[]
+        self.samples[name].append(seconds)
+
+    def findTV(self, address):
+        for tv in self.adapter.tvs.values():
+            if "%s:%s" % (tv.rest.address, tv.rest.port)==address:
+                return tv
+
+    def directive(self, tv, section, method, params):
+
+        # The controller call that sends this set request, or None when it cannot be expressed as one
+        params=params[0] if isinstance(params, list) and params else params or {}
+        if method=='setPowerStatus':
+            if params.get('status'):
+                return 'PowerController.TurnOn', sonybravia.PowerController.TurnOn(controller(self.adapter, tv))
+            return 'PowerController.TurnOff', sonybravia.PowerController.TurnOff(controller(self.adapter, tv))
+        if method=='setAudioVolume' and 'speaker' in tv.view.get('VolumeInformation', {}):
+            speaker=tv.view['VolumeInformation']['speaker']
+            unitconv=(speaker['maxVolume']-speaker['minVolume'])/100
+            volume=round((int(params['volume'])-speaker['minVolume'])/unitconv) if unitconv else int(params['volume'])
+            return 'SpeakerController.SetVolume', sonybravia.SpeakerController.SetVolume(controller(self.adapter, tv), { 'volume': volume })
+        if method=='setSoundSettings':
+            for setting in params.get('settings', []):
+                if setting.get('target')=='outputTerminal':
+                    return 'AudioModeController.SetMode', sonybravia.AudioModeController.SetMode(controller(self.adapter, tv, 'Audio', { setting['value']: setting['value'] }),
+                                                                                                    { 'mode': 'Audio.%s' % setting['value'] })
+        if method=='setPowerSavingMode':
+            return 'PowerSavingModeController.SetMode', sonybravia.PowerSavingModeController.SetMode(controller(self.adapter, tv, 'PowerSaving', { params['mode']: params['mode'] }),
+                                                                                                        { 'mode': 'PowerSaving.%s' % params['mode'] })
+        if method=='setPlayContent':
+            for name, uri in tv.input_uris.items():
+                if uri==params.get('uri'):
+                    return 'InputController.SelectInput', sonybravia.InputController.SelectInput(controller(self.adapter, tv), { 'input': name })
+        if method=='X_SendIRCC':
+            for name, code in tv.remote_codes.items():
+                if code==params:
+                    return 'RemoteController.PressRemoteButton', sonybravia.RemoteController.PressRemoteButton(controller(self.adapter, tv), { 'buttonName': name })
+        return None, None
+
+    def timed(self, name, coroutine):
+        async def run():
+            began=time.perf_counter()
+            try:
+                await coroutine
+            finally:
+                self.sample(name, time.perf_counter()-began)
+        self.tasks.append(asyncio.ensure_future(run()))
+
+    async def waitUntil(self, at):
+        self.cursor=max(self.cursor, at)
+        if self.args.speed:
+            delay=(at-self.recording.events[0][0])/self.args.speed-(self.loop.time()-self.base)
+            if delay>0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+
+    async def run(self):
+
+        self.adapter=self.makeAdapter()
+        protocol=BroadcastProtocol(self.loop, self.log, self.adapter.config.ssdpkeywords, returnmessage=self.adapter.processUPNP, addresses=self.adapter.tv_addresses)
+        skipped={}
+        self.base=self.loop.time()
+        began=time.perf_counter()
+        try:
+            for event in self.recording.events:
+                await self.waitUntil(event[0])
+                if event[1]=='tv':
+                    began_tv=time.perf_counter()
+                    await self.adapter.addTV(event[2])
+                    self.sample('addTV', time.perf_counter()-began_tv)
+                elif event[1]=='ssdp':
+                    began_datagram=time.perf_counter()
+                    protocol.datagram_received(event[2].encode('latin-1'), tuple(event[3]))
+                    self.sample('datagram_received', time.perf_counter()-began_datagram)
+                elif event[1]=='update' and event[3]=='poll':
+                    tv=self.adapter.tvs.get(event[2])
+                    if tv:
+                        self.timed('getUpdate (poll)', self.adapter.getUpdate(tv, event[4], trigger='poll'))
+                elif event[1] in ('set', 'ircc'):
+                    tv=self.findTV(event[2])
+                    name, coroutine=self.directive(tv, *event[3:]) if event[1]=='set' and tv else \
+                                        self.directive(tv, 'IRCC', 'X_SendIRCC', event[3]) if tv else (None, None)
+                    if coroutine:
+                        self.timed(name, coroutine)
+                    else:
+                        skipped[event[1]]=skipped.get(event[1], 0)+1
+            await asyncio.gather(*self.tasks)
+            # refreshes started by replayed SSDP packets are not tracked as tasks
+            while any(tv.pending_update is not None or tv.active_update is not None for tv in self.adapter.tvs.values()):
+                await asyncio.sleep(0.01)
+            elapsed=time.perf_counter()-began
+            for name, samples in self.samples.items():
+                report(name, samples, elapsed)
+            if self.recording.truncated:
+                print('the log ends without being closed, replayed up to its last complete record')
+            print('%s events, %s requests answered, %s not in the recording, %s set calls not replayable, %.2fs' %
+                    (len(self.recording.events), self.adapter.session.requests, self.adapter.session.unanswered, sum(skipped.values()), elapsed))
+        finally:
+            await self.adapter.stop()
+
+
+async def main(args):
+    log=logging.getLogger('replay')
+    logging.basicConfig(level=logging.WARNING if not args.verbose else logging.INFO)
+    driver=replay_driver(args, log)
+    if not args.profile:
+        return await driver.run()
+    profiler=cProfile.Profile()
+    profiler.enable()
+    try:
+        await driver.run()
+    finally:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(args.top)
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Replay recorded TV traffic through the sonybravia adapter')
+    parser.add_argument('log', help='traffic log written by the record_traffic setting')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 runs as fast as possible without the recorded latencies')
+    parser.add_argument('--config', help='adapter settings as a JSON object, over the replay defaults')
+    parser.add_argument('--profile', help='write cProfile stats for the replay to this file and print the top functions')
+    parser.add_argument('--top', type=int, default=25, help='functions to print with --profile')
+    parser.add_argument('--verbose', action='store_true')
+    asyncio.run(main(parser.parse_args()))
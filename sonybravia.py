@@ -12,6 +12,7 @@ import math
 import random
 from collections import namedtuple
 import json
+import copy
 #import definitions
 import asyncio
 import aiohttp
@@ -19,16 +20,29 @@ import xml.etree.ElementTree as et
 from collections import defaultdict
 import struct
 import socket
-import urllib.request
-import concurrent.futures # required for error message handling
+import time
+import bisect
+import gzip
+import heapq
+import itertools
+import urllib.parse
 
 class BroadcastProtocol:
 
-    def __init__(self, loop, log, keyphrases=[], returnmessage=None):
+    wanted_headers={ b'USN': 'usn', b'NTS': 'nts', b'NT': 'nt', b'ST': 'st', b'LOCATION': 'location', b'SERVER': 'server' }
+    ssdp_group=('239.255.255.250', 1900)
+
+    def __init__(self, loop, log, keyphrases=[], returnmessage=None, addresses=None, recorder=None):
         self.log=log
+        self.recorder=recorder
         self.loop = loop
         self.keyphrases=keyphrases
+        self.byte_keyphrases=[phrase.encode() for phrase in keyphrases]
+        # addresses is the adapter's live address map, so TVs added later are recognized without a restart
+        self.addresses=addresses if addresses is not None else {}
         self.returnMessage=returnmessage
+        self.datagrams=0
+        self.datagrams_dropped=0
 
 
     def connection_made(self, transport):
@@ -40,19 +54,37 @@ class BroadcastProtocol:
 
 
     def datagram_received(self, data, addr):
-        data=data.decode()
-        for phrase in self.keyphrases:
-            if data.find(phrase)>-1:
-                if data.find('upnp:rootdevice')>-1:
-                    self.processUPNPevent(data)
-                #return str(data)
-            #else:
-             #   self.log.info('>> not the right ssdp: %s' % (data))
-
-
-    def broadcast(self, data):
+        # Every UPnP device on the LAN multicasts here, so the cheap checks come first and are done on the raw
+        # bytes: the source address, then the keyphrases, then the root device header.  Only a packet that passes
+        # is parsed, once, and it schedules at most one refresh.
+        self.datagrams+=1
+        if self.recorder:
+            self.recorder.record('ssdp', data, addr)
+        if addr[0] not in self.addresses:
+            for phrase in self.byte_keyphrases:
+                if phrase in data:
+                    break
+            else:
+                self.datagrams_dropped+=1
+                return
+        if b'upnp:rootdevice' not in data:
+            self.datagrams_dropped+=1
+            return
+        self.processUPNPevent(self.parseHeaders(data), addr)
+
+    def parseHeaders(self, data):
+        headers={}
+        for line in data.split(b'\r\n')[1:]:
+            name, sep, value=line.partition(b':')
+            name=name.strip().upper()
+            if name in self.wanted_headers:
+                headers[self.wanted_headers[name]]=value.strip().decode('utf-8', 'replace')
+        return headers
+
+
+    def broadcast(self, data, target=None):
         self.log.info('>> ssdp/broadcast %s' % data)
-        self.transport.sendto(data.encode(), ('192.168.0.255', 9000))
+        self.transport.sendto(data.encode() if isinstance(data, str) else data, target if target else self.ssdp_group)
 
 
     def etree_to_dict(self, t):
@@ -77,103 +109,484 @@ class BroadcastProtocol:
         return d
 
 
-    def processUPNPevent(self, event):   
+    def processUPNPevent(self, event, addr=None):   
 
         try:
-            asyncio.ensure_future(self.returnMessage(event))
+            asyncio.ensure_future(self.returnMessage(event, addr))
+
+        except:
+            self.log.info("Error processing UPNP Event: %s " % event,exc_info=True)
+
+
+class SearchProtocol(BroadcastProtocol):
+
+    # Sends SSDP M-SEARCH requests from an ephemeral port and hands the parsed headers of every answer for the
+    # search target to returnmessage(headers, addr).  Answers come back unicast to this socket.
+
+    def __init__(self, loop, log, search_target, returnmessage=None):
+        super().__init__(loop, log, returnmessage=returnmessage)
+        self.search_target=search_target
+        self.byte_target=search_target.encode()
+
+    def connection_made(self, transport):
+        self.transport=transport
+
+    def datagram_received(self, data, addr):
+        self.datagrams+=1
+        if not data.startswith(b'HTTP/1.1 200') or self.byte_target not in data:
+            self.datagrams_dropped+=1
+            return
+        self.processUPNPevent(self.parseHeaders(data), addr)
+
+    def error_received(self, exc):
+        self.log.warning('.! ssdp search error: %s' % exc)
 
+    def connection_lost(self, exc):
+        pass
+
+    def search(self, mx=2, target=None):
+        self.broadcast('M-SEARCH * HTTP/1.1\r\nHOST: %s:%s\r\nMAN: "ssdp:discover"\r\nMX: %s\r\nST: %s\r\n\r\n' % (self.ssdp_group+(mx, self.search_target)), target)
+
+
+class traffic_recorder():
+
+    # Writes TV traffic to a gzipped log of compact JSON lines for replay_sonybravia.py.  The first line is a header,
+    # every other line is [seconds since the start, kind, ...] and bytes are stored as latin-1 text so they round trip.
+    #   tv      the addTV entry, without its preshared key
+    #   http    "address:port", path, request, latency, status, response
+    #   fail    "address:port", path, request, latency, failure kind
+    #   ssdp    datagram, [address, port]
+    #   update  TV name, trigger, getters or null
+    # A timer on the event loop flushes the compressor every flush_interval seconds while there are unflushed records,
+    # so the log of an adapter that is killed without stop() still replays up to a second before it ended.
+
+    flush_interval=1
+
+    def __init__(self, path, log=None, settings={}):
+        self.path=path
+        self.log=log
+        self.records=0
+        self.started=time.perf_counter()
+        self.file=gzip.open(path, 'wt', encoding='utf-8')
+        self.pending=False
+        self.timer=None
+        self.write({ 'version': 1, 'started': time.time(), 'settings': settings })
+        self.flush()
+
+    def write(self, record):
+        self.file.write(json.dumps(record, separators=(',', ':'))+'\n')
+        self.pending=True
+
+    def flush(self):
+        try:
+            if self.pending:
+                self.file.flush()
+                self.pending=False
+            self.timer=asyncio.get_event_loop().call_later(self.flush_interval, self.flush)
+        except:
+            self.log.error('!! Error flushing traffic log %s' % self.path, exc_info=True)
+
+    def record(self, kind, *fields, started=None):
+        try:
+            fields=[field.decode('latin-1') if isinstance(field, bytes) else field for field in fields]
+            self.write([round((started if started is not None else time.perf_counter())-self.started, 6), kind]+fields)
+            self.records+=1
+        except:
+            self.log.error('!! Error recording %s traffic' % kind, exc_info=True)
+
+    def close(self):
+        try:
+            if self.timer:
+                self.timer.cancel()
+            self.file.close()
+            self.log.info('.. recorded %s events to %s' % (self.records, self.path))
         except:
-            self.log.info("Error processing UPNP Event: %s " % upnpxml,exc_info=True)
+            self.log.error('!! Error closing traffic log %s' % self.path, exc_info=True)
+
+
+class tv_unreachable(Exception):
+    pass
+
+
+class tv_metrics():
+
+    # Request latency histograms and failure counts for one TV, keyed by "service/method"
+
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+    def __init__(self):
+        self.latency={}
+        self.failures={ 'timeouts':0, 'connect_failures':0, 'cancellations':0, 'errors':0, 'fast_fails':0 }
+        self.circuit_opens=0
+        self.method_failures={}
+        self.tv_errors={}
+        self.in_flight=0
+        self.in_flight_max=0
+        self.lane_waits={}
+        self.queue_depth=0
+        self.queue_depth_max=0
+        self.wakes={ 'count':0, 'total':0, 'max':0, 'last':0, 'timeouts':0 }
+
+    def enqueue(self):
+        self.queue_depth+=1
+        self.queue_depth_max=max(self.queue_depth, self.queue_depth_max)
+
+    def dequeue(self):
+        self.queue_depth-=1
+
+    def waited(self, lane, seconds):
+        if lane not in self.lane_waits:
+            self.lane_waits[lane]={ 'count':0, 'delayed':0, 'total':0, 'max':0 }
+        stats=self.lane_waits[lane]
+        stats['count']+=1
+        if seconds>0:
+            stats['delayed']+=1
+        stats['total']+=seconds
+        stats['max']=max(stats['max'], seconds)
+
+    def ready(self, seconds):
+        # time from a TurnOn until the TV reports active
+        self.wakes['count']+=1
+        self.wakes['total']+=seconds
+        self.wakes['max']=max(self.wakes['max'], seconds)
+        self.wakes['last']=seconds
+
+    def begin(self):
+        self.in_flight+=1
+        self.in_flight_max=max(self.in_flight, self.in_flight_max)
+
+    def end(self):
+        self.in_flight-=1
+
+    def observe(self, section, method, seconds):
+        key="%s/%s" % (section, method)
+        if key not in self.latency:
+            self.latency[key]={ 'count':0, 'total':0, 'max':0, 'buckets':[0]*(len(self.buckets)+1) }
+        stats=self.latency[key]
+        stats['count']+=1
+        stats['total']+=seconds
+        stats['max']=max(stats['max'], seconds)
+        stats['buckets'][bisect.bisect_left(self.buckets, seconds)]+=1
+
+    def failure(self, kind, section, method):
+        key="%s/%s" % (section, method)
+        self.failures[kind]+=1
+        if key not in self.method_failures:
+            self.method_failures[key]={}
+        self.method_failures[key][kind]=self.method_failures[key].get(kind, 0)+1
+
+    def tvError(self, section, method, error):
+        if isinstance(error, list) and len(error)>1:
+            error=error[1]
+        key="%s/%s %s" % (section, method, error)
+        self.tv_errors[key]=self.tv_errors.get(key, 0)+1
+
+    def dump(self):
+        latency={}
+        for key, stats in self.latency.items():
+            latency[key]={ 'count': stats['count'], 'avg_ms': round(stats['total']/stats['count']*1000, 2), 'max_ms': round(stats['max']*1000, 2),
+                            'buckets': dict(zip(['<=%sms' % int(bucket*1000) for bucket in self.buckets]+['>%sms' % int(self.buckets[-1]*1000)], stats['buckets'])) }
+        lanes={}
+        for lane, stats in self.lane_waits.items():
+            lanes[lane]={ 'count': stats['count'], 'delayed': stats['delayed'], 'avg_wait_ms': round(stats['total']/stats['count']*1000, 2), 'max_wait_ms': round(stats['max']*1000, 2) }
+        return { 'latency': latency, 'failures': dict(self.failures), 'method_failures': copy.deepcopy(self.method_failures), 'tv_errors': dict(self.tv_errors),
+                    'in_flight': self.in_flight, 'in_flight_max': self.in_flight_max, 'circuit_opens': self.circuit_opens,
+                    'rate_lanes': lanes, 'rate_queue_depth': self.queue_depth, 'rate_queue_depth_max': self.queue_depth_max,
+                    'time_to_ready': { 'count': self.wakes['count'], 'avg_ms': round(self.wakes['total']/self.wakes['count']*1000, 2) if self.wakes['count'] else 0,
+                                        'max_ms': round(self.wakes['max']*1000, 2), 'last_ms': round(self.wakes['last']*1000, 2), 'timeouts': self.wakes['timeouts'] } }
 
 
 class sony_rest():
 
-    def __init__(self, log=None, config=None):
+    # Rate limiter lanes, lowest goes first: user directives, then refresh reads, then background polls
+    priorities={ 'directive':0, 'refresh':1, 'poll':2 }
+
+    def __init__(self, log=None, config=None, address=None, port=None, preshared_key=None, session=None):
         self.config=config
         self.log=log
+        self.address=address if address else self.config.tv_address
+        self.port=port if port else self.config.tv_port
+        self.preshared_key=(preshared_key if preshared_key else self.config.tv_preshared_key) or ''
         self.tv_timeout=5
-    
-    async def remoteControl(self, params):
-
-        method = "POST"
-        url="sony/IRCC"
-        service='urn:schemas-sony-com:service:IRCC:1#X_SendIRCC'
-
-        soap = 	'<?xml version="1.0"?>'\
-            '<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'\
-            '<s:Body>'\
-            '<u:X_SendIRCC xmlns:u="urn:schemas-sony-com:service:IRCC:1">'\
-            '<IRCCCode>%s</IRCCCode>'\
-            '</u:X_SendIRCC>'\
-            '</s:Body>'\
-            '</s:Envelope>' % (params)
-
-        headers = {
-            'Host': "%s:%s" % (self.config.tv_address, self.config.tv_port),
-            'Content-length':len(soap),
+        # A session passed in is shared with the other TVs and owned by the adapter, otherwise this client makes its own
+        self.session=session
+        self.owns_session=session is None
+        self.metrics=tv_metrics()
+        self.batch_support={}
+        self.ircc_envelope=(b'<?xml version="1.0"?>'
+            b'<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/">'
+            b'<s:Body>'
+            b'<u:X_SendIRCC xmlns:u="urn:schemas-sony-com:service:IRCC:1">'
+            b'<IRCCCode>',
+            b'</IRCCCode>'
+            b'</u:X_SendIRCC>'
+            b'</s:Body>'
+            b'</s:Envelope>')
+        self.ircc_headers={
             'Content-Type':'text/xml; charset="utf-8"',
-            'X-Auth-PSK': self.config.tv_preshared_key,
-            'SOAPAction':'"%s"' % (service)
+            'X-Auth-PSK': self.preshared_key,
+            'SOAPAction':'"urn:schemas-sony-com:service:IRCC:1#X_SendIRCC"'
             }
+        self.request_semaphore=asyncio.Semaphore(max(1, self.config.refresh_concurrency))
+        # Circuit breaker: after circuit_failure_threshold timeouts or connect failures in a row the TV is treated as
+        # unreachable and requests fail at once until circuit_cooldown has passed, then a single probe decides
+        self.circuit_state='closed'
+        self.circuit_failures=0
+        self.circuit_opened=0
+        self.circuit_probe=False
+        self.circuit_callback=None
+        # Token bucket: tv_rate_limit requests a second with bursts of up to tv_rate_burst.  Requests that find it
+        # empty wait in a heap ordered by lane and arrival, so a directive is the next request out.
+        self.tokens=max(1, self.config.tv_rate_burst)
+        self.last_refill=time.monotonic()
+        self.waiters=[]
+        self.waiter_sequence=itertools.count()
+        self.limiter_task=None
+        self.recorder=None
+
+    def getSession(self):
+        # One long-lived session per TV so the keep-alive connection is reused between calls instead of
+        # paying the TCP setup for every JSON-RPC request
+        if self.owns_session and (self.session is None or self.session.closed):
+            connector=aiohttp.TCPConnector(limit=self.config.tv_connection_limit, limit_per_host=self.config.tv_connection_limit,
+                                            keepalive_timeout=self.config.tv_keepalive)
+            timeout=aiohttp.ClientTimeout(total=self.tv_timeout)
+            self.session=aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self.session
+
+    async def close(self):
+        try:
+            if self.limiter_task and not self.limiter_task.done():
+                self.limiter_task.cancel()
+            if self.owns_session and self.session is not None and not self.session.closed:
+                await self.session.close()
+                self.session=None
+        except:
+            self.log.error('!! Error closing TV session', exc_info=True)
+    
+    def setCircuit(self, state):
+        if state==self.circuit_state:
+            return
+        self.circuit_state=state
+        if state=='open':
+            self.circuit_opened=time.monotonic()
+            self.metrics.circuit_opens+=1
+            self.log.warning('.! %s is unreachable, failing requests fast for %ss' % (self.address, self.config.circuit_cooldown))
+        elif state=='closed':
+            self.log.info('.. %s is reachable again' % self.address)
+        if self.circuit_callback:
+            self.circuit_callback(state)
+
+    def circuitRetry(self):
+        # seconds until the breaker lets a probe through
+        if self.circuit_state!='open':
+            return 0
+        return max(0, self.config.circuit_cooldown-(time.monotonic()-self.circuit_opened))
+
+    def halfOpen(self):
+        # skips the rest of the cool-down when there is a sign of life from the TV, like an SSDP announcement
+        if self.circuit_state=='open':
+            self.setCircuit('half_open')
+
+    def circuitAllows(self):
+        if self.circuit_state=='closed':
+            return True
+        if self.circuit_state=='open' and not self.circuitRetry():
+            self.setCircuit('half_open')
+        if self.circuit_state=='half_open' and not self.circuit_probe:
+            self.circuit_probe=True
+            return True
+        return False
+
+    def circuitResult(self, reachable):
+        if reachable:
+            self.circuit_failures=0
+            self.setCircuit('closed')
+            return
+        self.circuit_failures+=1
+        if self.circuit_state=='half_open' or self.circuit_failures>=self.config.circuit_failure_threshold:
+            if self.circuit_state=='open':
+                return
+            self.setCircuit('open')
+
+    def refill(self):
+        now=time.monotonic()
+        self.tokens=min(max(1, self.config.tv_rate_burst), self.tokens+(now-self.last_refill)*self.config.tv_rate_limit)
+        self.last_refill=now
+
+    async def acquire(self, priority='refresh'):
+
+        # an open circuit fails requests without touching the TV, so they do not need a token
+        if not self.config.tv_rate_limit or self.circuit_state!='closed':
+            return
+        self.refill()
+        if not self.waiters and self.tokens>=1:
+            self.tokens-=1
+            self.metrics.waited(priority, 0)
+            return
+        future=asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (self.priorities.get(priority, 1), next(self.waiter_sequence), future))
+        self.metrics.enqueue()
+        if self.limiter_task is None or self.limiter_task.done():
+            self.limiter_task=asyncio.ensure_future(self.releaseTokens())
+        started=time.perf_counter()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # a token handed to a caller that has gone away is put back
+            if future.done() and not future.cancelled():
+                self.tokens+=1
+            else:
+                future.cancel()
+                self.metrics.dequeue()
+            raise
+        self.metrics.waited(priority, time.perf_counter()-started)
 
-        req = urllib.request.Request("http://%s:%s/%s" % (self.config.tv_address, self.config.tv_port, url), data=soap.encode('ascii'), headers=headers)
-        req.get_method = lambda: method
+    async def releaseTokens(self):
 
         try:
-            response = urllib.request.urlopen(req)
-        except urllib.HTTPError:
-            self.log.error("!! HTTP Error", exc_info=True)
-		
-        except urllib.URLError:
-            self.log.error("!! URL Error", exc_info=True)
+            while self.waiters:
+                self.refill()
+                while self.waiters and self.tokens>=1:
+                    lane, sequence, future=heapq.heappop(self.waiters)
+                    if future.done():
+                        continue
+                    self.tokens-=1
+                    self.metrics.dequeue()
+                    future.set_result(True)
+                if self.waiters:
+                    await asyncio.sleep((1-self.tokens)/self.config.tv_rate_limit)
+        except asyncio.CancelledError:
+            for lane, sequence, future in self.waiters:
+                future.cancel()
+            self.waiters=[]
+            raise
+
+    async def send(self, section, method, path, data, headers, priority='refresh'):
+
+        # Every request to the TV goes through here so latency and failures are measured in one place.
+        # priority None means the caller already took a rate limiter token.
+        if priority:
+            await self.acquire(priority)
+        if not self.circuitAllows():
+            self.metrics.failure('fast_fails', section, method)
+            raise tv_unreachable(self.address)
+        probe=self.circuit_state=='half_open'
+        started=time.perf_counter()
+        self.metrics.begin()
+        try:
+            async with self.getSession().post("http://%s:%s/%s" % (self.address, self.port, path), data=data, headers=headers, 
+                                                timeout=aiohttp.ClientTimeout(total=self.config.tv_request_timeout)) as response:
+                body=await response.read()
+                self.metrics.observe(section, method, time.perf_counter()-started)
+                if self.recorder:
+                    self.recorder.record('http', "%s:%s" % (self.address, self.port), path, data, time.perf_counter()-started, response.status, body, started=started)
+                self.circuitResult(True)
+                return response.status, body
+        except asyncio.TimeoutError:
+            self.metrics.failure('timeouts', section, method)
+            if self.recorder:
+                self.recorder.record('fail', "%s:%s" % (self.address, self.port), path, data, time.perf_counter()-started, 'timeouts', started=started)
+            self.circuitResult(False)
+            raise
+        except aiohttp.client_exceptions.ClientConnectorError:
+            self.metrics.failure('connect_failures', section, method)
+            if self.recorder:
+                self.recorder.record('fail', "%s:%s" % (self.address, self.port), path, data, time.perf_counter()-started, 'connect_failures', started=started)
+            self.circuitResult(False)
+            raise
+        except asyncio.CancelledError:
+            self.metrics.failure('cancellations', section, method)
+            raise
+        except:
+            self.metrics.failure('errors', section, method)
+            raise
+        finally:
+            if probe:
+                self.circuit_probe=False
+            self.metrics.end()
 
-        else:
-            tree = response.read()
+    async def remoteControl(self, params, priority='directive'):
+
+        # The IRCC envelope and headers never change apart from the code itself, so they are built once and the
+        # command goes through the same pooled session as the JSON-RPC calls instead of a blocking urlopen.
+        try:
+            data=self.ircc_envelope[0]+params.encode('ascii')+self.ircc_envelope[1]
+            status, tree=await self.send('IRCC', 'X_SendIRCC', 'sony/IRCC', data, self.ircc_headers, priority=priority)
+            if status>=400:
+                self.log.error("!! HTTP Error sending IRCC code %s: %s %s" % (params, status, tree))
+                return None
             #self.log.info('<- command Sent: %s' % str(tree))
             return tree
 
+        except asyncio.CancelledError:
+            raise
+
+        except tv_unreachable:
+            pass
 
-    async def getState(self, section, method, version='1.0', params=[]):
+        except asyncio.TimeoutError:
+            self.log.error('!! Timeout sending IRCC code to TV - %s' % params)
+
+        except aiohttp.client_exceptions.ClientConnectorError:
+            self.log.error('!! Error sending IRCC code to TV (could not connect, likely DNS or IP related) - %s' % params)
+
+        except:
+            self.log.error('!! Error sending IRCC code to TV - %s' % params, exc_info=True)
+
+
+    def buildCommand(self, method, version='1.0', params=[], id=2):
         
-        try:
-            url = "http://%s/sony/%s" % (self.config.tv_address,section)
-            headers={'X-Auth-PSK': self.config.tv_preshared_key}
-            command={'id':2, 'method':method, 'version':version}
-            if params==[]:
-                command['params']=[]
+        command={'id':id, 'method':method, 'version':version}
+        if params==[]:
+            command['params']=[]
+        else:
+            command['params']=[params]
+        return command
+
+    def parseResult(self, result, data, section='', method=''):
+        
+        if 'result' in result:
+            result=result['result']
+            return result
+        if 'results' in result:
+            result=result['results']
+            for subresult in result:
+                self.log.info('Multi-result: %s' % subresult)
+            return result
+        elif 'error' in result:
+            self.metrics.tvError(section, method, result['error'])
+            if 'Display Is Turned off' in result['error']:
+                pass
+            elif 'Illegal State' in result['error']:
+                pass
+
             else:
-                command['params']=[params]
-            data=json.dumps(command)
-            
-            timeout = aiohttp.ClientTimeout(total=self.tv_timeout)
-            async with aiohttp.ClientSession(timeout=timeout) as client:
-                response=await client.post(url, data=data, headers=headers)
-                result=await response.read()
-                result=json.loads(result.decode())
-                
-                if 'result' in result:
-                    result=result['result']
-                    return result
-                if 'results' in result:
-                    result=result['results']
-                    for subresult in result:
-                        self.log.info('Multi-result: %s' % subresult)
-                    return result
-                elif 'error' in result:
-                    if 'Display Is Turned off' in result['error']:
-                        pass
-                    elif 'Illegal State' in result['error']:
-                        pass
+                self.log.error('Error result: %s %s' % (result, data))
+            return {}
+        else:
+            self.log.info('Result has no result: %s' % result)
+            return result
 
-                    else:
-                        self.log.error('Error result: %s %s' % (result, data))
-                    return {}
-                else:
-                    self.log.info('Result has no result: %s' % result)
-                    return result
+    async def getState(self, section, method, version='1.0', params=[], priority='refresh'):
+        
+        try:
+            headers={'X-Auth-PSK': self.preshared_key}
+            data=json.dumps(self.buildCommand(method, version, params))
+            
+            status, result=await self.send(section, method, "sony/%s" % section, data, headers, priority=priority)
+            result=json.loads(result)
+            return self.parseResult(result, data, section, method)
                     
-        except concurrent.futures._base.CancelledError:
+        except asyncio.CancelledError:
             self.log.error('!! Error sending command to TV (cancelled) - %s/%s %s' % (section, method, params) )
+            raise
+
+        except tv_unreachable:
+            return {}
+
+        except asyncio.TimeoutError:
+            self.log.error('!! Timeout sending command to TV - %s/%s %s' % (section, method, params) )
             return {}
 
         except aiohttp.client_exceptions.ClientConnectorError:
@@ -184,6 +597,244 @@ class sony_rest():
             self.log.error('!! Error sending command to TV - %s/%s %s' % (section, method, params), exc_info=True)
             return {}
 
+    async def getLimited(self, section, method, version='1.0', params=[], priority='refresh'):
+        
+        # The token is taken before the semaphore so lower lanes cannot hold every slot while a refresh waits behind them
+        await self.acquire(priority)
+        async with self.request_semaphore:
+            try:
+                return await asyncio.wait_for(self.getState(section, method, version=version, params=params, priority=None), timeout=self.config.tv_request_timeout)
+            except asyncio.TimeoutError:
+                self.log.error('!! Timeout getting TV state - %s/%s' % (section, method))
+                return {}
+
+    async def getServiceBatch(self, section, requests, priority='refresh'):
+        
+        # Sends every method for one service endpoint as a single JSON-RPC batch.  Firmware that does not
+        # understand batches answers with a single error object instead of a list, so the service is
+        # remembered as unbatchable and the methods are sent as concurrent single calls instead.  An HTTP error or a
+        # body that is not JSON counts the same way, unless the service has answered a batch before.  Transport
+        # errors, like a keep-alive connection the TV dropped, leave the batch to be tried again next time.
+        if self.batch_support.get(section)!=False:
+            try:
+                headers={'X-Auth-PSK': self.preshared_key}
+                commands=[self.buildCommand(method, version, params, id=i+1) for i, (method, version, params) in enumerate(requests)]
+                data=json.dumps(commands)
+                await self.acquire(priority)
+                async with self.request_semaphore:
+                    status, result=await self.send(section, '+'.join([command['method'] for command in commands]), "sony/%s" % section, data, headers, priority=None)
+                try:
+                    result=json.loads(result) if status<300 else None
+                except ValueError:
+                    result=None
+                if isinstance(result, list):
+                    self.batch_support[section]=True
+                    byid={}
+                    for subresult in result:
+                        if isinstance(subresult, dict) and 'id' in subresult:
+                            byid[subresult['id']]=subresult
+                    results=[]
+                    for command in commands:
+                        if command['id'] in byid:
+                            results.append(self.parseResult(byid[command['id']], command, section, command['method']))
+                        else:
+                            results.append(await self.getLimited(section, command['method'], version=command['version'], params=command['params'][0] if command['params'] else [], priority=priority))
+                    return results
+                if self.batch_support.get(section):
+                    self.log.warning('.! batch for %s failed (HTTP %s), using single requests this time' % (section, status))
+                else:
+                    self.log.info('.. batch requests not supported for %s (HTTP %s), using single requests' % (section, status))
+                    self.batch_support[section]=False
+
+            except asyncio.CancelledError:
+                raise
+
+            except tv_unreachable:
+                return [{} for request in requests]
+
+            except asyncio.TimeoutError:
+                self.log.error('!! Timeout sending batch to TV - %s %s' % (section, [method for method, version, params in requests]))
+                return [{} for request in requests]
+
+            except aiohttp.client_exceptions.ClientConnectorError:
+                self.log.error('!! Error sending batch to TV (could not connect, likely DNS or IP related) - %s' % section)
+                return [{} for request in requests]
+
+            except aiohttp.ClientError as error:
+                self.log.error('!! Error sending batch to TV - %s: %s' % (section, repr(error)))
+                return [{} for request in requests]
+
+            except:
+                self.log.error('!! Error sending batch to TV - %s' % section, exc_info=True)
+                return [{} for request in requests]
+
+        return await asyncio.gather(*[self.getLimited(section, method, version=version, params=params, priority=priority) for method, version, params in requests])
+
+    async def getBatch(self, requests, priority='refresh'):
+        
+        # requests is a list of (service, method, version, params) tuples and the results come back in the same order
+        services={}
+        for index, (section, method, version, params) in enumerate(requests):
+            if section not in services:
+                services[section]=[]
+            services[section].append((index, (method, version, params)))
+
+        sections=list(services.keys())
+        allresults=await asyncio.gather(*[self.getServiceBatch(section, [request for index, request in services[section]], priority=priority) for section in sections])
+        results=[{}]*len(requests)
+        for section, sectionresults in zip(sections, allresults):
+            for (index, request), result in zip(services[section], sectionresults):
+                results[index]=result
+        return results
+
+
+class sony_notifications():
+
+    # Subscribes to the notifications newer firmware pushes over a WebSocket on the same /sony/<service> endpoints
+    # as the JSON-RPC calls, and hands each event to callback(getter, value) with the getter it replaces.
+
+    services={  'system':       { 'notifyPowerStatus': 'PowerStatus' },
+                'audio':        { 'notifyVolumeInformation': 'VolumeInformation' },
+                'avContent':    { 'notifyPlayingContentInfo': 'PlayingContentInfo' }
+            }
+    # handshake answers that mean the firmware has no WebSocket on the endpoint at all
+    missing_statuses=(404, 405, 501)
+
+    def __init__(self, rest, log=None, config=None, callback=None, session=None):
+        self.rest=rest
+        self.log=log
+        self.config=config
+        self.callback=callback
+        # The sockets stay open, so they get their own pool instead of holding connections the requests need
+        self.session=session
+        self.owns_session=session is None
+        self.active={}
+        self.unsupported=set()
+        self.tasks=[]
+        self.events=0
+        self.reconnects=0
+
+    def pushed(self, getter):
+        for service in self.services:
+            if getter in self.services[service].values():
+                return self.active.get(service, False)
+        return False
+
+    def start(self):
+        self.tasks=[asyncio.ensure_future(self.listen(service)) for service in self.services]
+
+    def getSession(self):
+        if self.owns_session and (self.session is None or self.session.closed):
+            self.session=aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=len(self.services)))
+        return self.session
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks=[]
+        self.active={}
+        if self.owns_session and self.session is not None and not self.session.closed:
+            await self.session.close()
+
+    async def request(self, ws, command):
+        # events can arrive between a request and its answer, so wait for the matching id
+        await ws.send_str(json.dumps(command))
+        while True:
+            message=await ws.receive(timeout=self.config.tv_request_timeout)
+            if message.type!=aiohttp.WSMsgType.TEXT:
+                raise ConnectionError('notification socket closed: %s' % message.type)
+            data=json.loads(message.data)
+            if data.get('id')==command['id']:
+                return data
+            await self.dispatch(data)
+
+    async def dispatch(self, data):
+        for service in self.services:
+            if data.get('method') in self.services[service] and data.get('params'):
+                self.events+=1
+                await self.callback(self.services[service][data['method']], data['params'][0])
+                return
+
+    async def listen(self, service):
+        
+        backoff=1
+        url="ws://%s:%s/sony/%s" % (self.rest.address, self.rest.port, service)
+        while True:
+            try:
+                async with self.getSession().ws_connect(url, headers={'X-Auth-PSK': self.rest.preshared_key}, heartbeat=30) as ws:
+                    # An empty switchNotifications lists what this firmware offers without changing anything
+                    available=await self.request(ws, { 'method': 'switchNotifications', 'id': 1, 'version': '1.0', 'params': [{}] })
+                    if 'result' not in available:
+                        self.log.info('.. %s notifications are not supported on %s: %s' % (service, self.rest.address, available))
+                        self.unsupported.add(service)
+                        return
+                    offered=available['result'][0].get('enabled', [])+available['result'][0].get('disabled', [])
+                    enable=[item for item in offered if item['name'] in self.services[service]]
+                    if not enable:
+                        self.unsupported.add(service)
+                        return
+                    await self.request(ws, { 'method': 'switchNotifications', 'id': 2, 'version': '1.0', 'params': [{ 'enabled': enable, 'disabled': [] }] })
+                    self.active[service]=True
+                    backoff=1
+                    self.log.info('.. listening for %s notifications from %s' % (service, self.rest.address))
+                    async for message in ws:
+                        if message.type==aiohttp.WSMsgType.TEXT:
+                            await self.dispatch(json.loads(message.data))
+                        elif message.type in [aiohttp.WSMsgType.ERROR, aiohttp.WSMsgType.CLOSE]:
+                            break
+
+            except asyncio.CancelledError:
+                self.active[service]=False
+                raise
+            except aiohttp.client_exceptions.WSServerHandshakeError as error:
+                if error.status in self.missing_statuses:
+                    # older firmware has no WebSocket on this endpoint, so there is nothing to reconnect to
+                    self.log.info('.. %s notifications are not available on %s' % (service, self.rest.address))
+                    self.unsupported.add(service)
+                    self.active[service]=False
+                    return
+                # an auth failure or a set that is still booting can refuse the upgrade for now
+                self.log.warning('.! %s notifications refused by %s (HTTP %s), trying again' % (service, self.rest.address, error.status))
+            except:
+                self.log.error('!! Error with %s notifications from %s' % (service, self.rest.address), exc_info=True)
+
+            self.active[service]=False
+            self.reconnects+=1
+            await asyncio.sleep(backoff*(1+random.uniform(0, 0.2)))
+            backoff=min(backoff*2, self.config.notification_backoff_max)
+
+
+class bravia_tv():
+
+    # The per-TV state the adapter keeps next to each sony_rest client: its refresh scheduler and poll schedule
+
+    def __init__(self, rest=None, name=None, friendlyName="TV", hdmi_port_names={}):
+        self.rest=rest
+        self.name=name
+        self.friendlyName=friendlyName
+        self.hdmi_port_names=hdmi_port_names
+        self.input_list=list(hdmi_port_names.values())
+        # name -> setPlayContent URI, so selecting an input is one lookup
+        self.input_uris={ name: 'extInput:hdmi?port=%s' % port for port, name in hdmi_port_names.items() }
+        self.remote_codes={}
+        self.notifications=None
+        self.power_active=True
+        self.poll_backoff=1
+        self.last_activity=0
+        self.poll_wakeup=asyncio.Event()
+        self.pending_update=None
+        self.pending_getters=None
+        self.pending_priority='refresh'
+        self.active_update=None
+        self.last_update=0
+        self.command_queue=[]
+        self.command_drained=asyncio.Event()
+        self.command_task=None
+        self.view={}
+        self.revalidate_task=None
+        self.poll_task=None
+        self.mac=None
+        self.waking=None
 
 
 class sonybravia(sofabase):
@@ -192,16 +843,64 @@ class sonybravia(sofabase):
     
         def adapter_fields(self):
             self.hdmi_port_names=self.set_or_default('hdmi_port_names', default={})
-            self.tv_address=self.set_or_default("tv_address", mandatory=True)
+            self.tv_address=self.set_or_default("tv_address", default=None)
             self.tv_port=self.set_or_default("tv_port", default=80)
-            self.tv_preshared_key=self.set_or_default("tv_preshared_key", mandatory=True)
-            self.ssdpkeywords=self.set_or_default("ssdpkeywords", default=[self.tv_address, "bravia"])
+            self.tv_preshared_key=self.set_or_default("tv_preshared_key", default=None)
+            # Each entry is { "address": ..., "preshared_key": ..., "port": 80, "name": "Living Room", "hdmi_port_names": {...}, "mac": ... }
+            # and the single tv_address/tv_preshared_key pair is still accepted as the first TV
+            self.tvs=self.set_or_default("tvs", default=[])
+            if self.tv_address:
+                self.tvs=[{ "address": self.tv_address, "port": self.tv_port, "preshared_key": self.tv_preshared_key }]+self.tvs
+            self.ssdpkeywords=self.set_or_default("ssdpkeywords", default=[tv['address'] for tv in self.tvs]+["bravia"])
+            # Active discovery finds sets that answer an M-SEARCH for the Sony ScalarWebAPI and adds them as they are found.
+            # It is on by default only when no TVs are configured.
+            self.discovery=self.set_or_default("discovery", default=len(self.tvs)==0)
+            self.discovery_interval=self.set_or_default("discovery_interval", default=300)
+            self.discovery_timeout=self.set_or_default("discovery_timeout", default=3)
+            self.tv_connection_pool_limit=self.set_or_default("tv_connection_pool_limit", default=100)
+            self.metrics_interval=self.set_or_default("metrics_interval", default=0)
+            self.notifications=self.set_or_default("notifications", default=True)
+            self.optimistic_updates=self.set_or_default("optimistic_updates", default=False)
+            self.command_queue_depth=self.set_or_default("command_queue_depth", default=16)
+            self.notification_health_interval=self.set_or_default("notification_health_interval", default=120)
+            self.notification_backoff_max=self.set_or_default("notification_backoff_max", default=60)
+            # Static TV data (system information, remote codes, app list) is kept in this file between restarts, off unless set
+            self.snapshot_cache=self.set_or_default("snapshot_cache", default='')
+            # Every request, response and SSDP datagram is written to this file for replay_sonybravia.py, empty turns it off
+            self.record_traffic=self.set_or_default("record_traffic", default='')
+            self.tv_connection_limit=self.set_or_default("tv_connection_limit", default=6)
+            self.tv_keepalive=self.set_or_default("tv_keepalive", default=30)
+            self.tv_request_timeout=self.set_or_default("tv_request_timeout", default=5)
+            self.refresh_concurrency=self.set_or_default("refresh_concurrency", default=6)
+            self.refresh_debounce=self.set_or_default("refresh_debounce", default=0.25)
+            self.circuit_failure_threshold=self.set_or_default("circuit_failure_threshold", default=3)
+            self.circuit_cooldown=self.set_or_default("circuit_cooldown", default=30)
+            # TurnOn on a set that is off waits until it reports active, polling wake_poll_interval apart and doubling
+            # up to wake_poll_max, and can send a Wake-on-LAN packet first for sets that switch their network off.
+            self.wake_on_lan=self.set_or_default("wake_on_lan", default=False)
+            self.wake_broadcast=self.set_or_default("wake_broadcast", default='255.255.255.255')
+            self.wake_port=self.set_or_default("wake_port", default=9)
+            self.wake_poll_interval=self.set_or_default("wake_poll_interval", default=0.25)
+            self.wake_poll_max=self.set_or_default("wake_poll_max", default=1)
+            self.wake_timeout=self.set_or_default("wake_timeout", default=30)
+            # Requests per second allowed to each TV, 0 turns the limiter off
+            self.tv_rate_limit=self.set_or_default("tv_rate_limit", default=20)
+            self.tv_rate_burst=self.set_or_default("tv_rate_burst", default=20)
+            self.poll_intervals=self.set_or_default("poll_intervals", default={ 'PowerStatus': 5, 'VolumeInformation': 15, 'PlayingContentInfo': 15,
+                                                                                'SoundSettings': 60, 'CurrentExternalInputsStatus': 120, 'PowerSavingMode': 300 })
+            self.poll_active_interval=self.set_or_default("poll_active_interval", default=2)
+            self.poll_active_window=self.set_or_default("poll_active_window", default=30)
+            self.poll_backoff_max=self.set_or_default("poll_backoff_max", default=60)
+            self.poll_jitter=self.set_or_default("poll_jitter", default=0.1)
 
     class EndpointHealth(devices.EndpointHealth):
 
         @property            
         def connectivity(self):
-            return 'OK'
+            try:
+                return self.nativeObject['Connectivity']['value']
+            except KeyError:
+                return 'OK'
 
     class PowerController(devices.PowerController):
 
@@ -211,8 +910,7 @@ class sonybravia(sofabase):
 
         async def TurnOn(self, correlationToken=''):
             try:
-                sysinfo=await self.adapter.tv.getState('system', 'setPowerStatus', params={"status":True})
-                await self.adapter.getUpdate()
+                await self.adapter.powerOn(self.adapter.getTV(self.device))
                 return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)
             except:
                 self.adapter.log.error('!! Error during TurnOn', exc_info=True)
@@ -220,8 +918,9 @@ class sonybravia(sofabase):
         
         async def TurnOff(self, correlationToken=''):
             try:
-                sysinfo=await self.adapter.tv.getState('system', 'setPowerStatus', params={"status":False})
-                await self.adapter.getUpdate()
+                tv=self.adapter.getTV(self.device)
+                sysinfo=await self.adapter.queueCommand(tv, 'system', 'setPowerStatus', params={"status":False})
+                await self.adapter.applyDirective(tv, 'PowerController.TurnOff', sysinfo, {'PowerStatus': {'status': 'standby'}})
                 return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)
             except:
                 self.adapter.log.error('!! Error during TurnOff', exc_info=True)
@@ -232,15 +931,7 @@ class sonybravia(sofabase):
         @property            
         def mode(self):
             try:
-                for item in self.nativeObject['SoundSettings']:
-                    if item['target']=='outputTerminal':
-                        otmode="%s.%s" % (self.name,item['currentValue'])
-                        return otmode
-                        self.log.info('## %s vs %s' % (otmode, self._supportedModes))
-                        for mode in self._supportedModes:
-                            if otmode==[mode]:
-                                return otmode
-                return ""
+                return "%s.%s" % (self.name, self.adapter.getTV(self.device).view['SoundSettings']['outputTerminal']['currentValue'])
             except KeyError:
                 return ""
                 #self.adapter.log.error('Error checking mode status - no value present: %s' % self.nativeObject)
@@ -257,8 +948,13 @@ class sonybravia(sofabase):
                             self.log.warn('!! Warning: wont try to change audio mode while tv is off')
                         else:
                             self.log.info('.. setting tv setSoundSettings to %s' % mode)
-                            sysinfo=await self.adapter.tv.getState('audio','setSoundSettings',version="1.1",params={"settings": [{ "value": mode, "target": "outputTerminal"} ] })
-                            await self.adapter.getUpdate()
+                            tv=self.adapter.getTV(self.device)
+                            sysinfo=await self.adapter.queueCommand(tv, 'audio','setSoundSettings',version="1.1",params={"settings": [{ "value": mode, "target": "outputTerminal"} ] })
+                            settings=self.adapter.expectedState(tv, 'SoundSettings', [])
+                            for item in settings:
+                                if item['target']=='outputTerminal':
+                                    item['currentValue']=mode
+                            await self.adapter.applyDirective(tv, 'AudioModeController.SetMode', sysinfo, {'SoundSettings': settings})
                         return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)     
                     self.log.error('!! error - did not find mode %s in %s/%s' % (payload, self.name, self._supportedModes))
             except:
@@ -293,8 +989,9 @@ class sonybravia(sofabase):
                             self.log.warn('!! Warning: wont try to change power saving mode while tv is off')
                         else:
                             self.log.info('.. setting tv setPowerSavingMode to %s' % mode)
-                            sysinfo=await self.adapter.tv.getState('system','setPowerSavingMode',version="1.0",params={"mode": mode})
-                            await self.adapter.getUpdate()
+                            tv=self.adapter.getTV(self.device)
+                            sysinfo=await self.adapter.queueCommand(tv, 'system','setPowerSavingMode',version="1.0",params={"mode": mode})
+                            await self.adapter.applyDirective(tv, 'PowerSavingModeController.SetMode', sysinfo, {'PowerSavingMode': {'mode': mode}})
                         return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)     
                     self.log.error('!! error - did not find mode %s in %s/%s' % (payload, self.name, self._supportedModes))
             except:
@@ -308,7 +1005,7 @@ class sonybravia(sofabase):
         @property            
         def input(self):
             try:
-                return self.adapter.parse_input_name(self.nativeObject)
+                return self.adapter.parse_input_name(self.nativeObject, self.adapter.getTV(self.device))
             except KeyError:
                 if self.nativeObject['PowerStatus']['status']=="active":
                     return 'Android TV'
@@ -320,18 +1017,20 @@ class sonybravia(sofabase):
                     
         async def SelectInput(self,payload, correlationToken=''):
             try:
+                tv=self.adapter.getTV(self.device)
+                sysinfo=None
+                expected=None
                 if payload['input']=='Home':
-                    sysinfo=await self.adapter.tv.remoteControl(self.adapter.findRemoteCode('Home'))
+                    sysinfo=await self.adapter.queueCommand(tv, 'IRCC', 'X_SendIRCC', params=self.adapter.findRemoteCode(tv, 'Home'))
                 else:
-                    inp=payload['input']
-                    for port in self.device.adapter.config.hdmi_port_names:
-                        if payload['input']==self.device.adapter.config.hdmi_port_names[port]:
-                            inp='extInput:hdmi?port=%s' % port
-                            sysinfo=await self.adapter.tv.getState('avContent','setPlayContent',params={"uri":inp})
-                            if inp.startswith('extInput:cec'):
-                                # takes slightly longer for CEC sources to switch than raw AV inputs
-                                await asyncio.sleep(.2)
-                await self.adapter.getUpdate()
+                    inp=tv.input_uris.get(payload['input'])
+                    if inp:
+                        sysinfo=await self.adapter.queueCommand(tv, 'avContent','setPlayContent',params={"uri":inp})
+                        expected={'PlayingContentInfo': {'uri': inp}}
+                        if inp.startswith('extInput:cec'):
+                            # takes slightly longer for CEC sources to switch than raw AV inputs
+                            await asyncio.sleep(.2)
+                await self.adapter.applyDirective(tv, 'InputController.SelectInput', sysinfo, expected)
                 return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)
             except:
                 self.adapter.log.error('Error in SelectInput', exc_info=True)
@@ -342,9 +1041,7 @@ class sonybravia(sofabase):
         @property            
         def volume(self):
             try:
-                for item in self.nativeObject['VolumeInformation']:
-                    if item['target']=='speaker':
-                        return item['volume']
+                return self.adapter.getTV(self.device).view['VolumeInformation']['speaker']['volume']
             except KeyError:
                 pass
                 #self.adapter.log.error('Error checking mode status - no value present: %s' % self.nativeObject)
@@ -355,9 +1052,7 @@ class sonybravia(sofabase):
         @property            
         def mute(self):
             try:
-                for item in self.nativeObject['VolumeInformation']:
-                    if item['target']=='speaker':
-                        return item['mute']
+                return self.adapter.getTV(self.device).view['VolumeInformation']['speaker']['mute']
             except KeyError:
                 return False
                 #self.adapter.log.error('Error checking mode status - no value present: %s' % self.nativeObject)
@@ -368,20 +1063,21 @@ class sonybravia(sofabase):
 
         async def SetVolume(self, payload, correlationToken=''):
             try:
-                for item in self.nativeObject['SoundSettings']:
-                    if item['target']=='outputTerminal':
-                        if item['currentValue']!='speaker':
-                            self.log.warning('.! cancelled attempt to set volume while the TV is not in speaker mode')
-                            return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)
-
-                for item in self.nativeObject['VolumeInformation']:
-                    if item['target']=='speaker':
-                        volrange={ 'max':item['maxVolume'], 'min':item['minVolume'] }
-                unitconv=(volrange['max']-volrange['min'])/100
-                realvol=str(int(float(unitconv* int(payload['volume'])))+volrange['min'])
+                tv=self.adapter.getTV(self.device)
+                if tv.view.get('SoundSettings', {}).get('outputTerminal', {}).get('currentValue', 'speaker')!='speaker':
+                    self.log.warning('.! cancelled attempt to set volume while the TV is not in speaker mode')
+                    return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)
+
+                speaker=tv.view['VolumeInformation']['speaker']
+                unitconv=(speaker['maxVolume']-speaker['minVolume'])/100
+                realvol=str(int(float(unitconv* int(payload['volume'])))+speaker['minVolume'])
                 # { "method": "setAudioVolume", "id": 601,"params": [{ "volume": "18","target": "speaker"}],"version": "1.0"}
-                sysinfo=await self.adapter.tv.getState('audio','setAudioVolume',params={"volume":realvol, "target":"speaker"})
-                await self.adapter.getUpdate()
+                sysinfo=await self.adapter.queueCommand(tv, 'audio','setAudioVolume',params={"volume":realvol, "target":"speaker"})
+                volumes=self.adapter.expectedState(tv, 'VolumeInformation', [])
+                for item in volumes:
+                    if item['target']=='speaker':
+                        item['volume']=int(realvol)
+                await self.adapter.applyDirective(tv, 'SpeakerController.SetVolume', sysinfo, {'VolumeInformation': volumes})
                 return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)
             except:
                 self.log.error('!! Error during SetVolume', exc_info=True)
@@ -398,9 +1094,11 @@ class sonybravia(sofabase):
 
         async def PressRemoteButton(self, payload, correlationToken=''):
             try:
-                if self.adapter.findRemoteCode(payload['buttonName']):
-                    sysinfo=await self.adapter.tv.remoteControl(self.adapter.findRemoteCode(payload['buttonName']))
-                await self.adapter.getUpdate()
+                tv=self.adapter.getTV(self.device)
+                code=self.adapter.findRemoteCode(tv, payload['buttonName'])
+                if code:
+                    sysinfo=await self.adapter.queueCommand(tv, 'IRCC', 'X_SendIRCC', params=code)
+                await self.adapter.refreshAfter(tv, 'RemoteController.PressRemoteButton')
                 return await self.adapter.dataset.generateResponse(self.device.endpointId, correlationToken)
             except:
                 self.adapter.log.error('Error in PressRemoteButton', exc_info=True)
@@ -408,6 +1106,48 @@ class sonybravia(sofabase):
 
     class adapterProcess(adapterbase):
 
+        update_getters={    'PowerStatus':                  ('system', { 'interface': 'power', 'command':'getPowerStatus', 'listitem':0 }),
+                            'PowerSavingMode':              ('system', { 'interface': 'system', 'command':'getPowerSavingMode', 'listitem':0 }),
+                            'VolumeInformation':            ('audio', { 'interface':'audio', 'command':'getVolumeInformation', 'listitem':0}),
+                            'SoundSettings':                ('audio', { 'interface':'audio', 'command':'getSoundSettings', 'version':'1.1', 'listitem':0, 'params':{"target": ""}}),
+                            'PlayingContentInfo':           ('avContent', { 'interface':'playingContent', 'command':'getPlayingContentInfo', 'listitem':0 }),
+                            'CurrentExternalInputsStatus':  ('avContent', { 'interface':'inputStatus', 'command':'getCurrentExternalInputsStatus', 'version':'1.1', 'listitem':0 })
+                        }
+
+        # The getters each directive can affect.  Power changes and remote buttons can change anything so they are
+        # left out and get a full refresh.
+        directive_getters={ 'SpeakerController.SetVolume':          ['VolumeInformation'],
+                            'AudioModeController.SetMode':          ['SoundSettings', 'VolumeInformation'],
+                            'PowerSavingModeController.SetMode':    ['PowerSavingMode'],
+                            'InputController.SelectInput':          ['PlayingContentInfo', 'CurrentExternalInputsStatus']
+                        }
+
+        # Other names for the IRCC buttons, in the lowercase alphanumeric form used by the remote code index
+        remote_aliases={    'volup': 'volumeup', 'voldown': 'volumedown', 'chup': 'channelup', 'chdown': 'channeldown',
+                            'select': 'confirm', 'ok': 'confirm', 'enter': 'confirm', 'back': 'return', 'menu': 'actionmenu',
+                            'info': 'display', 'fastforward': 'forward', 'previous': 'prev', 'power': 'tvpower'
+                        }
+
+        # URI types whose port maps onto hdmi_port_names, and how many parsed URIs getDetailsFromURI keeps
+        port_input_types=frozenset(['cec', 'hdmi', 'player'])
+        # getters whose list results are indexed by target for the controller properties
+        target_views=frozenset(['VolumeInformation', 'SoundSettings'])
+        # what the snapshot cache restores at startup.  PowerStatus is only the last known state, it is needed to
+        # register the device and is replaced by the first refresh.
+        cached_getters=('SystemInformation', 'RemoteControllerInfo', 'PowerStatus')
+        # the application fields kept from getApplicationList, in the order they are stored
+        application_fields=('title', 'uri')
+        # what discovery searches for: only sets with the Sony JSON-RPC API answer it
+        search_target='urn:schemas-sony-com:service:ScalarWebAPI:1'
+        uri_cache_size=64
+        # what queueCommand answers a command that was replaced by a newer one for the same target before it was sent
+        superseded=object()
+        # rate limiter lane for each refresh trigger, anything else is a refresh read
+        trigger_lanes={ 'command': 'directive', 'wake': 'directive', 'poll': 'poll' }
+        # adapter settings that change the timing of the traffic, kept in a recording so a replay runs the same way
+        recorded_settings=( 'refresh_debounce', 'refresh_concurrency', 'optimistic_updates', 'command_queue_depth', 'tv_request_timeout',
+                            'tv_rate_limit', 'tv_rate_burst', 'circuit_failure_threshold', 'circuit_cooldown',
+                            'wake_poll_interval', 'wake_poll_max', 'wake_timeout' )
 
         def __init__(self, log=None, dataset=None, notify=None, request=None, loop=None, config=None, **kwargs):
             self.config=config
@@ -415,7 +1155,25 @@ class sonybravia(sofabase):
 
             self.log=log
             self.notify=notify
-            self.polltime=5
+            self.tvs={}
+            self.tv_addresses={}
+            self.session=None
+            self.notification_session=None
+            self.suppressed_updates=0
+            self.refresh_triggers={}
+            self.optimistic={ 'applied':0, 'confirmed':0, 'disagreed':0, 'rolled_back':0 }
+            self.commands={ 'received':0, 'sent':0, 'coalesced':0, 'waits':0, 'depth_max':0 }
+            self.snapshot={}
+            self.ingests_skipped=0
+            self.ingests_performed=0
+            self.uri_cache={}
+            self.endpoint_tvs={}
+            self.static_cache={}
+            self.discovered={}
+            self.discovery_task=None
+            self.metrics_task=None
+            self.retry_tasks=[]
+            self.recorder=None
             if not loop:
                 self.loop = asyncio.new_event_loop()
             else:
@@ -432,42 +1190,333 @@ class sonybravia(sofabase):
             sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)    
             return sock            
 
-        async def processUPNP(self, message):
+        async def processUPNP(self, message, addr=None):
             try:
-                await self.getUpdate()
+                # Route the packet to the TV that sent it.  Keyword matches from unknown addresses can only be
+                # attributed when there is a single TV.
+                tv=None
+                if addr and addr[0] in self.tv_addresses:
+                    tv=self.tv_addresses[addr[0]]
+                elif len(self.tvs)==1:
+                    tv=list(self.tvs.values())[0]
+                if tv:
+                    if addr and addr[0]==tv.rest.address:
+                        tv.rest.halfOpen()
+                    await self.getUpdate(tv, trigger='ssdp')
+            except asyncio.CancelledError:
+                raise
             except:
                 self.log.error('Error processing UPNP: %s' % message, exc_info=True)
             
+        def getTV(self, device):
+            try:
+                return self.endpoint_tvs[device.endpointId]
+            except KeyError:
+                tv=self.tvs[device.endpointId.split(':')[2]]
+                self.endpoint_tvs[device.endpointId]=tv
+                return tv
 
-        async def getInitialData(self):
+        def deriveView(self, tv, getter, value):
+            # The list results the controller properties read are indexed by target once per change, so building a
+            # state report is a few dict lookups.  Items are shared with the snapshot, which is never changed in place.
+            if getter in self.target_views:
+                tv.view[getter]={ item['target']: item for item in value if isinstance(item, dict) and 'target' in item } if isinstance(value, list) else {}
+
+        async def getInitialData(self, tv):
 
             systemdata={    'system':       [ { 'interface': 'systemInformation', 'command':'getSystemInformation', 'listitem':0 },
                                               { 'interface': 'remoteCommands', 'command':'getRemoteControllerInfo', 'listitem':1 }],
-                            'appControl':   [ { 'interface': 'applications', 'command':'getApplicationList'}]
+                            'appControl':   [ { 'interface': 'applications', 'command':'getApplicationList', 'fields': self.application_fields }]
                         }
-            return await self.getStates(systemdata)
+            return await self.getStates(tv, systemdata)
+
+        async def refreshAfter(self, tv, directive):
+            
+            # Only refresh the getters a directive can change, falling back to a full refresh for anything unmapped
+            tv.last_activity=self.loop.time()
+            tv.poll_backoff=1
+            tv.poll_wakeup.set()
+            return await self.getUpdate(tv, self.directive_getters.get(directive))
+
+        async def queueCommand(self, tv, section, method, version='1.0', params=[]):
+
+            # Commands for a TV go out one at a time in the order they arrived.  A setting still waiting at the back of
+            # the queue is replaced by a newer one for the same target, so only the latest value is sent, and the callers
+            # it replaced get self.superseded once it has gone out.  Remote presses queued back to back go out as one run.
+            # A full queue holds new commands until there is room.
+            try:
+                if section=='IRCC':
+                    key=(section,)
+                else:
+                    key=(section, method, params.get('target') if isinstance(params, dict) else None)
+                future=self.loop.create_future()
+                self.commands['received']+=1
+                while True:
+                    if tv.command_queue and tv.command_queue[-1]['key']==key:
+                        entry=tv.command_queue[-1]
+                        if section!='IRCC':
+                            entry['params']=params
+                            entry['superseded']+=entry['futures']
+                            entry['futures']=[future]
+                            self.commands['coalesced']+=1
+                            break
+                        if len(entry['params'])<self.config.command_queue_depth:
+                            entry['params'].append(params)
+                            entry['futures'].append(future)
+                            break
+                    if len(tv.command_queue)<self.config.command_queue_depth:
+                        tv.command_queue.append({ 'key': key, 'section': section, 'method': method, 'version': version,
+                                                    'params': [params] if section=='IRCC' else params, 'futures': [future], 'superseded': [] })
+                        self.commands['depth_max']=max(self.commands['depth_max'], len(tv.command_queue))
+                        break
+                    self.commands['waits']+=1
+                    tv.command_drained.clear()
+                    await tv.command_drained.wait()
+
+                if tv.command_task is None or tv.command_task.done():
+                    tv.command_task=asyncio.ensure_future(self.runCommands(tv))
+                return await future
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.error('!! Error queueing command %s/%s for %s' % (section, method, tv.name), exc_info=True)
+                return {}
 
-        async def getUpdate(self):
+        async def runCommands(self, tv):
 
-            systemdata={    'system':       [ { 'interface': 'power', 'command':'getPowerStatus', 'listitem':0 },
-                                                { 'interface': 'system', 'command':'getPowerSavingMode', 'listitem':0 }],
-                            'audio':        [ { 'interface':'audio', 'command':'getVolumeInformation', 'listitem':0},
-                                                { 'interface':'audio', 'command':'getSoundSettings', 'version':'1.1', 'listitem':0, 'params':{"target": ""}}
-                                            ],
-                            'avContent':    [ { 'interface':'playingContent', 'command':'getPlayingContentInfo', 'listitem':0 },
-                                              { 'interface':'inputStatus', 'command':'getCurrentExternalInputsStatus', 'version':'1.1', 'listitem':0 }]
-                        }
+            entry=None
+            try:
+                while tv.command_queue:
+                    entry=tv.command_queue.pop(0)
+                    tv.command_drained.set()
+                    result={}
+                    try:
+                        if entry['section']=='IRCC':
+                            for code in entry['params']:
+                                result=await tv.rest.remoteControl(code, priority='directive')
+                            self.commands['sent']+=len(entry['params'])
+                        else:
+                            result=await tv.rest.getState(entry['section'], entry['method'], version=entry['version'], params=entry['params'], priority='directive')
+                            self.commands['sent']+=1
+                    except asyncio.CancelledError:
+                        raise
+                    except:
+                        self.log.error('!! Error sending command %s/%s to %s' % (entry['section'], entry['method'], tv.name), exc_info=True)
+                    for future in entry['futures']:
+                        if not future.done():
+                            future.set_result(result)
+                    for future in entry['superseded']:
+                        if not future.done():
+                            future.set_result(self.superseded)
+                    entry=None
+            except asyncio.CancelledError:
+                for pending in ([entry] if entry else [])+tv.command_queue:
+                    for future in pending['futures']+pending['superseded']:
+                        future.cancel()
+                tv.command_queue=[]
+                tv.command_drained.set()
+
+        def expectedState(self, tv, getter, default=None):
+            # a copy of the last ingested result that a directive can edit into the state it expects
+            return copy.deepcopy(self.snapshot.get(tv.name, {}).get(getter, default))
+
+        def matchesExpected(self, expected, actual):
+            # the TV may report more fields than a directive predicts, so only the predicted ones are compared
+            if isinstance(expected, dict) and isinstance(actual, dict):
+                return all(key in actual and self.matchesExpected(expected[key], actual[key]) for key in expected)
+            if isinstance(expected, list) and isinstance(actual, list):
+                return len(expected)==len(actual) and all(self.matchesExpected(item, other) for item, other in zip(expected, actual))
+            return expected==actual
+
+        async def applyDirective(self, tv, directive, sysinfo=None, expected=None, refresh=None):
+
+            # In optimistic mode a set call that succeeded (the TV answered with a result list) puts the expected state
+            # straight into the dataset so the response can go out, and the refresh that confirms it runs in the background.
+            # refresh replaces the usual refreshAfter with another coroutine function that returns the refreshed state.
+            # A superseded command never reached the TV, so its expected state is not ingested or reconciled and the
+            # directive that replaced it reports the result.
+            try:
+                if sysinfo is self.superseded and self.config.optimistic_updates:
+                    return
+                if self.config.optimistic_updates and expected and isinstance(sysinfo, list):
+                    previous={ getter: self.expectedState(tv, getter) for getter in expected }
+                    self.optimistic['applied']+=1
+                    await self.ingestState(tv.name, expected)
+                    asyncio.ensure_future(self.reconcile(tv, directive, expected, previous, refresh))
+                    return
+            except:
+                self.log.error('!! Error applying optimistic state for %s' % directive, exc_info=True)
+            if refresh:
+                await refresh()
+            else:
+                await self.refreshAfter(tv, directive)
+
+        async def reconcile(self, tv, directive, expected, previous, refresh=None):
+            
+            try:
+                actual=await refresh() if refresh else await self.refreshAfter(tv, directive)
+                for getter in expected:
+                    if not actual or not actual.get(getter):
+                        # the TV did not answer, so the optimistic state is unconfirmed and the last known state goes back
+                        self.optimistic['rolled_back']+=1
+                        if previous[getter] is not None:
+                            await self.ingestState(tv.name, { getter: previous[getter] })
+                    elif not self.matchesExpected(expected[getter], actual[getter]):
+                        # the refresh has already ingested what the TV reports
+                        self.optimistic['disagreed']+=1
+                        self.log.info('.. %s on %s expected %s but the TV reports %s' % (directive, tv.name, expected[getter], actual[getter]))
+                    else:
+                        self.optimistic['confirmed']+=1
+            except:
+                self.log.error('!! Error reconciling %s' % directive, exc_info=True)
+
+        async def powerOn(self, tv):
+
+            # A TurnOn that arrives while the set is still waking waits on the same wake instead of starting another
+            if tv.waking is None or tv.waking.done():
+                tv.waking=asyncio.ensure_future(self.wakeTV(tv))
+            return await asyncio.shield(tv.waking)
+
+        async def wakeTV(self, tv):
+
+            try:
+                started=self.loop.time()
+                refresh=None
+                woken=False
+                waking=self.snapshot.get(tv.name, {}).get('PowerStatus', {}).get('status')!='active'
+                if waking and self.config.wake_on_lan:
+                    woken=self.wakeOnLan(tv)
+                sysinfo=await self.queueCommand(tv, 'system', 'setPowerStatus', params={"status":True})
+                # Readiness is only waited for when the set took the command or was sent a magic packet, otherwise
+                # nothing is going to wake it and the response would hang for the whole wake_timeout.
+                if waking and (woken or isinstance(sysinfo, list)):
+                    refresh=lambda: self.waitReady(tv, started)
+                await self.applyDirective(tv, 'PowerController.TurnOn', sysinfo, {'PowerStatus': {'status': 'active'}}, refresh)
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.error('!! Error waking %s' % tv.name, exc_info=True)
+
+        def wakeOnLan(self, tv):
+
+            # The MAC comes from the TV entry or the cached system information, so a set that has been seen once can be woken
+            try:
+                mac=tv.mac or self.snapshot.get(tv.name, {}).get('SystemInformation', {}).get('macAddr')
+                if not mac:
+                    self.log.warning('.! no MAC address known for %s, not sending Wake-on-LAN' % tv.name)
+                    return False
+                packet=b'\xff'*6+bytes.fromhex(mac.replace(':', '').replace('-', ''))*16
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                    sock.sendto(packet, (self.config.wake_broadcast, self.config.wake_port))
+                self.log.info('.. sent Wake-on-LAN to %s (%s)' % (tv.name, mac))
+                # a breaker opened while the set was asleep lets the readiness checks through now
+                tv.rest.halfOpen()
+                return True
+            except:
+                self.log.error('!! Error sending Wake-on-LAN to %s' % tv.name, exc_info=True)
+                return False
+
+        async def waitReady(self, tv, started):
+
+            # Until the set reports active most calls are answered with Illegal State or Display Is Turned off, so only
+            # getPowerStatus is asked and the full refresh goes out once, after it is ready or wake_timeout has passed.
+            tv.last_activity=self.loop.time()
+            tv.poll_backoff=1
+            interval=self.config.wake_poll_interval
+            while True:
+                status=await tv.rest.getState('system', 'getPowerStatus', priority='directive')
+                if isinstance(status, list) and status and status[0].get('status')=='active':
+                    tv.rest.metrics.ready(self.loop.time()-started)
+                    self.log.info('.. %s ready %.2fs after TurnOn' % (tv.name, self.loop.time()-started))
+                    break
+                if self.loop.time()-started+interval>self.config.wake_timeout:
+                    tv.rest.metrics.wakes['timeouts']+=1
+                    self.log.warning('.! %s did not report active within %ss of TurnOn' % (tv.name, self.config.wake_timeout))
+                    break
+                await asyncio.sleep(interval)
+                interval=min(interval*2, self.config.wake_poll_max)
+            tv.poll_wakeup.set()
+            return await self.getUpdate(tv, trigger='wake')
+
+        async def getUpdate(self, tv, getters=None, trigger='command'):
+
+            # Single-flight refresh: every caller that arrives while a refresh is waiting to start shares it, so
+            # a burst of SSDP packets or volume presses costs one trailing refresh instead of one each.
+            # getters limits the refresh to those result names and callers merge their sets; None is a full refresh.
+            # The refresh that confirms a directive shares the directive lane of the rate limiter, background polls go out in
+            # the lowest lane and a shared refresh takes the lane of its most urgent caller.
+            try:
+                self.refresh_triggers[trigger]=self.refresh_triggers.get(trigger, 0)+1
+                if self.recorder:
+                    self.recorder.record('update', tv.name, trigger, sorted(getters) if getters is not None else None)
+                priority=self.trigger_lanes.get(trigger, 'refresh')
+                if tv.pending_update is not None:
+                    self.suppressed_updates+=1
+                    if getters is None or tv.pending_getters is None:
+                        tv.pending_getters=None
+                    else:
+                        tv.pending_getters.update(getters)
+                    if sony_rest.priorities[priority]<sony_rest.priorities[tv.pending_priority]:
+                        tv.pending_priority=priority
+                else:
+                    tv.pending_getters=None if getters is None else set(getters)
+                    tv.pending_priority=priority
+                    tv.pending_update=asyncio.ensure_future(self.runUpdate(tv))
+                return await asyncio.shield(tv.pending_update)
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.error('!! Error during coalesced update', exc_info=True)
+
+        async def runUpdate(self, tv):
+            
+            try:
+                # A refresh that is already in flight may have started before the caller's change reached the TV,
+                # so the next one waits for it to finish and for the rest of the debounce window.
+                if tv.active_update is not None:
+                    await asyncio.wait([tv.active_update])
+                delay=tv.last_update+self.config.refresh_debounce-self.loop.time()
+                if delay>0:
+                    await asyncio.sleep(delay)
+            finally:
+                getters=tv.pending_getters
+                priority=tv.pending_priority
+                tv.pending_update=None
+
+            tv.active_update=asyncio.current_task()
+            tv.last_update=self.loop.time()
+            try:
+                return await self.fetchUpdate(tv, getters, priority=priority)
+            finally:
+                tv.active_update=None
+
+        async def fetchUpdate(self, tv, getters=None, priority='refresh'):
+
+            systemdata={}
+            for getter in self.update_getters:
+                if getters is None or getter in getters:
+                    category, action=self.update_getters[getter]
+                    if category not in systemdata:
+                        systemdata[category]=[]
+                    systemdata[category].append(action)
                                               
-            return await self.getStates(systemdata)
+            return await self.getStates(tv, systemdata, priority=priority)
 
 
-        async def getStates(self, systemdata):
+        async def getStates(self, tv, systemdata, priority='refresh'):
             
             alldata={}
+            results={}
             
             try:
+                # Actions are grouped per service and sent as one batch per endpoint, so a full refresh costs
+                # about one round trip per service instead of one per action.
+                actions=[]
+                requests=[]
                 for category in systemdata:
-                    results={}
+                    if category not in alldata:
+                        alldata[category]={}
                     for action in systemdata[category]:
                         cmdver="1.0"
                         if 'version' in action:
@@ -475,61 +1524,465 @@ class sonybravia(sofabase):
                         params=[]
                         if 'params' in action:
                             params=action['params']
-                        sysinfo=await self.tv.getState(category, action['command'], version=cmdver, params=params)
-                        if sysinfo and 'listitem' in action:
-                            sysinfo=sysinfo[action['listitem']]
-                            results[action['command'][3:]]=sysinfo
-                        if category not in alldata:
-                            alldata[category]={}
-                        alldata[action['command'][3:]]=sysinfo
-                    await self.dataset.ingest({'tv': { self.tvName: results }}, mergeReplace=True)
+                        actions.append(action)
+                        requests.append((category, action['command'], cmdver, params))
+                allinfo=await tv.rest.getBatch(requests, priority=priority)
+                for action, sysinfo in zip(actions, allinfo):
+                    if sysinfo and 'listitem' in action:
+                        sysinfo=sysinfo[action['listitem']]
+                        results[action['command'][3:]]=sysinfo
+                    elif sysinfo and 'fields' in action:
+                        sysinfo=self.projectItems(sysinfo, action['fields'])
+                    alldata[action['command'][3:]]=sysinfo
+                if 'PowerStatus' in alldata:
+                    # an empty result means the TV did not answer, which is treated the same as off for polling
+                    tv.power_active=bool(alldata['PowerStatus']) and alldata['PowerStatus'].get('status')=="active"
+                await self.ingestState(tv.name, results)
                 return alldata
                 
+            except asyncio.CancelledError:
+                raise
             except:
                 self.log.error('error with update',exc_info=True)
 
-        async def getTVname(self):
+        async def ingestState(self, tvName, results):
             
-            sysinfo=await self.tv.getState('system','getSystemInformation')
-            return sysinfo[0]['name']
+            # Only the getters whose result differs from the last ingested copy are sent to the dataset, so steady
+            # polling of an unchanged TV does no merge or change evaluation work downstream.
+            try:
+                if tvName not in self.snapshot:
+                    self.snapshot[tvName]={}
+                changes={}
+                for getter in results:
+                    if getter not in self.snapshot[tvName] or self.snapshot[tvName][getter]!=results[getter]:
+                        changes[getter]=results[getter]
+                if not changes:
+                    self.ingests_skipped+=1
+                    return False
+                for getter in changes:
+                    self.snapshot[tvName][getter]=copy.deepcopy(changes[getter])
+                    if tvName in self.tvs:
+                        self.deriveView(self.tvs[tvName], getter, self.snapshot[tvName][getter])
+                if 'RemoteControllerInfo' in changes and tvName in self.tvs:
+                    self.buildRemoteIndex(self.tvs[tvName], changes['RemoteControllerInfo'])
+                self.ingests_performed+=1
+                await self.dataset.ingest({'tv': { tvName: changes }}, mergeReplace=True)
+                return True
+            except:
+                self.log.error('!! Error ingesting TV state', exc_info=True)
 
-        async def start(self):
+        async def handleNotification(self, tv, getter, value):
+            
             try:
-                self.input_list=[]
-                for port in self.config.hdmi_port_names:
-                    self.input_list.append(self.config.hdmi_port_names[port])
+                self.refresh_triggers['push']=self.refresh_triggers.get('push', 0)+1
+                if getter=='VolumeInformation':
+                    # volume events carry a single target, so merge it into the last full list
+                    volumes=[]
+                    for item in self.snapshot.get(tv.name, {}).get('VolumeInformation', []):
+                        if item.get('target')==value.get('target'):
+                            volumes.append(dict(item, **value))
+                            value=None
+                        else:
+                            volumes.append(item)
+                    if value is not None:
+                        volumes.append(value)
+                    value=volumes
+                elif getter=='PowerStatus':
+                    was_active=tv.power_active
+                    tv.power_active=value.get('status')=="active"
+                    if tv.power_active!=was_active:
+                        # the other getters were not polled while the TV was off
+                        tv.poll_wakeup.set()
+                await self.ingestState(tv.name, { getter: value })
             except:
-                self.log.error('Error defining port list', exc_info=True)
-                
-            self.tv=sony_rest(log=self.log, config=self.config)
-            self.tvName=await self.getTVname()
+                self.log.error('!! Error handling %s notification' % getter, exc_info=True)
+
+        def circuitChanged(self, tv, state):
+            # the breaker state goes into the device so EndpointHealth reports it and a change report goes out
+            connectivity={ 'value': 'OK' if state=='closed' else 'UNREACHABLE', 'circuit': state }
+            asyncio.ensure_future(self.ingestState(tv.name, { 'Connectivity': connectivity }))
+
+        async def getTVname(self, tv):
+            
+            sysinfo=await tv.rest.getState('system','getSystemInformation')
+            return sysinfo[0]['name'] if sysinfo else None
+
+        def projectItems(self, result, fields):
+            # Keeps only the named fields of each item in a list result like [[{...}, {...}]], as a short list in the
+            # order of fields, so a few hundred apps with icons and intent data are held as [title, uri] pairs.
+            try:
+                return [[item.get(field) for field in fields] for item in result[0]] if result else []
+            except:
+                self.log.error('!! Error projecting result', exc_info=True)
+                return []
+
+        def cacheKey(self, sysinfo):
+            # a cached entry is only trusted for the same set on the same firmware.  generation is the API generation
+            # and rarely moves, so the firmware build is part of the key on sets that report one.
+            return "%s/%s/%s/%s" % (sysinfo.get('model'), sysinfo.get('serial'), sysinfo.get('generation'), sysinfo.get('fwVersion'))
 
+        def cacheSlot(self, rest):
+            # entries are kept per address and port, so sets behind one address do not overwrite each other
+            return "%s:%s" % (rest.address, rest.port)
+
+        def loadStaticCache(self):
             try:
-                await self.getInitialData()
-                await self.getUpdate()
+                if self.config.snapshot_cache and os.path.exists(self.config.snapshot_cache):
+                    with open(self.config.snapshot_cache) as cachefile:
+                        self.static_cache=json.load(cachefile)
+                    # a cache written before the port was part of the slot is keyed by the address alone
+                    for slot in [slot for slot in self.static_cache if ':' not in slot]:
+                        self.static_cache.setdefault("%s:%s" % (slot, self.config.tv_port), self.static_cache.pop(slot))
+                    self.log.info('.. loaded cached data for %s' % list(self.static_cache.keys()))
+            except:
+                self.log.error('!! Error loading TV snapshot cache %s' % self.config.snapshot_cache, exc_info=True)
+                self.static_cache={}
 
+        def saveStaticCache(self):
+            try:
+                if self.config.snapshot_cache:
+                    if os.path.dirname(self.config.snapshot_cache):
+                        os.makedirs(os.path.dirname(self.config.snapshot_cache), exist_ok=True)
+                    with open(self.config.snapshot_cache+'.tmp', 'w') as cachefile:
+                        json.dump(self.static_cache, cachefile)
+                    os.replace(self.config.snapshot_cache+'.tmp', self.config.snapshot_cache)
             except:
-                self.log.error('error with update',exc_info=True)
+                self.log.error('!! Error saving TV snapshot cache %s' % self.config.snapshot_cache, exc_info=True)
+
+        def cacheTV(self, tv, alldata):
+            try:
+                if not alldata or not alldata.get('SystemInformation') or not alldata.get('RemoteControllerInfo'):
+                    return
+                entry={ 'key': self.cacheKey(alldata['SystemInformation']), 'name': tv.name, 'ApplicationList': alldata.get('ApplicationList') }
+                for getter in self.cached_getters:
+                    if getter in self.snapshot.get(tv.name, {}):
+                        entry[getter]=self.snapshot[tv.name][getter]
+                self.static_cache[self.cacheSlot(tv.rest)]=entry
+                self.saveStaticCache()
+            except:
+                self.log.error('!! Error caching static data for %s' % tv.name, exc_info=True)
+
+        async def revalidate(self, tv, cached):
+
+            # Everything is fetched again when the system information no longer matches.  Otherwise the app list and
+            # the remote codes are compared in the background, since the app list can change at any time and not every
+            # set reports the firmware update that changes its codes.  The cached power state is replaced by the live
+            # one, so the next startup does not register a stale one.
+            try:
+                update, sysinfo=await asyncio.gather(self.getUpdate(tv, trigger='startup'), tv.rest.getState('system','getSystemInformation'))
+                if update and update.get('PowerStatus') and update['PowerStatus']!=cached.get('PowerStatus'):
+                    cached['PowerStatus']=update['PowerStatus']
+                    self.saveStaticCache()
+                if not sysinfo:
+                    return
+                if self.cacheKey(sysinfo[0])!=cached['key']:
+                    self.log.info('.. %s reports %s instead of the cached %s, refreshing its static data' % (tv.name, self.cacheKey(sysinfo[0]), cached['key']))
+                    self.cacheTV(tv, await self.getInitialData(tv))
+                    return
+                applications, remote=await asyncio.gather(tv.rest.getState('appControl','getApplicationList'), tv.rest.getState('system','getRemoteControllerInfo'))
+                applications=self.projectItems(applications, self.application_fields)
+                changed=False
+                if applications and applications!=cached.get('ApplicationList'):
+                    self.log.info('.. app list changed on %s' % tv.name)
+                    cached['ApplicationList']=applications
+                    changed=True
+                if remote and len(remote)>1 and remote[1]!=cached.get('RemoteControllerInfo'):
+                    self.log.info('.. remote codes changed on %s' % tv.name)
+                    await self.ingestState(tv.name, { 'RemoteControllerInfo': remote[1] })
+                    cached['RemoteControllerInfo']=remote[1]
+                    changed=True
+                if changed:
+                    self.saveStaticCache()
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.error('!! Error revalidating cached data for %s' % tv.name, exc_info=True)
+
+        async def addTV(self, entry):
+            
+            try:
+                if self.recorder:
+                    self.recorder.record('tv', { key: entry[key] for key in ('address', 'port', 'name', 'hdmi_port_names', 'mac') if key in entry })
+                rest=sony_rest(log=self.log, config=self.config, address=entry['address'], port=entry.get('port', self.config.tv_port), 
+                                preshared_key=entry.get('preshared_key', self.config.tv_preshared_key), session=self.session)
+                rest.recorder=self.recorder
+                tv=bravia_tv(rest=rest, friendlyName=entry.get('name', entry.get('friendlyName', 'TV')), hdmi_port_names=entry.get('hdmi_port_names', self.config.hdmi_port_names))
+                tv.mac=entry.get('mac')
+                # A configured name keeps the device key stable across restarts, otherwise the name the TV reports is used
+                cached=self.static_cache.get(self.cacheSlot(rest))
+                if 'name' in entry:
+                    tv.name=entry['name']
+                elif cached:
+                    tv.name=cached['name']
+                else:
+                    tv.name=await self.getTVname(tv)
+                    if not tv.name:
+                        self.log.warning('.! %s did not report its name, it will be tried again' % rest.address)
+                        await rest.close()
+                        return None
+                if tv.name in self.tvs:
+                    tv.name="%s-%s" % (tv.name, rest.address)
+                self.tvs[tv.name]=tv
+                self.tv_addresses[rest.address]=tv
+                rest.circuit_callback=lambda state: self.circuitChanged(tv, state)
+                if cached:
+                    # The device is registered from the cached data at once, and the TV is asked in the background
+                    # whether its firmware or app list has changed since.
+                    await self.ingestState(tv.name, { getter: cached[getter] for getter in self.cached_getters if getter in cached })
+                    tv.revalidate_task=asyncio.ensure_future(self.revalidate(tv, cached))
+                else:
+                    alldata=await self.getInitialData(tv)
+                    await self.getUpdate(tv, trigger='startup')
+                    self.cacheTV(tv, alldata)
+                if self.config.notifications:
+                    tv.notifications=sony_notifications(rest, log=self.log, config=self.config, callback=lambda getter, value: self.handleNotification(tv, getter, value),
+                                                        session=self.notification_session)
+                    tv.notifications.start()
+                return tv
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.error('!! Error adding TV %s' % entry.get('address'), exc_info=True)
+
+        async def start(self):
+
+            # Every TV shares one connection pool, with tv_connection_limit connections per TV
+            connector=aiohttp.TCPConnector(limit=self.config.tv_connection_pool_limit, limit_per_host=self.config.tv_connection_limit,
+                                            keepalive_timeout=self.config.tv_keepalive)
+            self.session=aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.config.tv_request_timeout))
+            self.notification_session=aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0, limit_per_host=len(sony_notifications.services)))
+
+            self.loadStaticCache()
+            if self.config.record_traffic:
+                self.startRecording(self.config.record_traffic)
+            added=await asyncio.gather(*[self.addTV(entry) for entry in self.config.tvs])
+            # each poll loop is a task on its TV so closeTV stops it with the rest of the TV's work
+            for entry, tv in zip(self.config.tvs, added):
+                if tv:
+                    tv.poll_task=asyncio.ensure_future(self.pollTV(tv))
+                else:
+                    self.retry_tasks.append(asyncio.ensure_future(self.retryTV(entry)))
+            if self.config.metrics_interval:
+                self.metrics_task=asyncio.ensure_future(self.dumpMetrics())
+            if self.config.discovery:
+                self.discovery_task=asyncio.ensure_future(self.discover())
 
             try:
                 sock=self.make_ssdp_sock()
-                self.ssdp = self.loop.create_datagram_endpoint(lambda: BroadcastProtocol(self.loop, self.log, self.config.ssdpkeywords, returnmessage=self.processUPNP), sock=sock)
+                self.ssdp = self.loop.create_datagram_endpoint(lambda: BroadcastProtocol(self.loop, self.log, self.config.ssdpkeywords, returnmessage=self.processUPNP, addresses=self.tv_addresses,
+                                                                                        recorder=self.recorder), sock=sock)
                 await self.ssdp
-                await self.pollTV()
                 
             except:
                 self.log.error('error with ssdp',exc_info=True)
+
+        async def retryTV(self, entry):
+
+            # A configured set that could not be added at startup, like one that is unplugged, is tried again with the
+            # same backoff as the power poll of a set that is off instead of being dropped until the next restart
+            delay=self.config.poll_intervals.get('PowerStatus', 5)
+            while True:
+                await asyncio.sleep(delay*(1+random.uniform(0, self.config.poll_jitter)))
+                if entry['address'] in self.tv_addresses:
+                    return self.tv_addresses[entry['address']]
+                tv=await self.addTV(entry)
+                if tv:
+                    tv.poll_task=asyncio.ensure_future(self.pollTV(tv))
+                    return tv
+                delay=min(delay*2, max(delay, self.config.poll_backoff_max))
+
+        def startRecording(self, path):
+            try:
+                folder=os.path.dirname(path)
+                if folder:
+                    os.makedirs(folder, exist_ok=True)
+                self.recorder=traffic_recorder(path, log=self.log, settings={ name: getattr(self.config, name) for name in self.recorded_settings })
+                for tv in self.tvs.values():
+                    tv.rest.recorder=self.recorder
+                self.log.info('.. recording TV traffic to %s' % path)
+            except:
+                self.log.error('!! Error starting traffic recording to %s' % path, exc_info=True)
+
+        async def discover(self):
+            while True:
+                try:
+                    await self.discoverTVs()
+                    await asyncio.sleep(self.config.discovery_interval)
+                except asyncio.CancelledError:
+                    break
+                except:
+                    self.log.error('!! Error during TV discovery', exc_info=True)
+                    await asyncio.sleep(self.config.discovery_interval)
+
+        async def discoverTVs(self, target=None):
+
+            # Answers are handled as they arrive, each description is fetched concurrently, and the search socket
+            # is closed after discovery_timeout.  The M-SEARCH goes out twice since UDP can drop it.
+            transport, protocol=await self.loop.create_datagram_endpoint(lambda: SearchProtocol(self.loop, self.log, self.search_target, returnmessage=self.processSearchResponse),
+                                                                            local_addr=('0.0.0.0', 0))
+            try:
+                mx=max(1, int(self.config.discovery_timeout)-1)
+                protocol.search(mx, target)
+                await asyncio.sleep(min(0.5, self.config.discovery_timeout/2))
+                protocol.search(mx, target)
+                await asyncio.sleep(self.config.discovery_timeout)
+            finally:
+                transport.close()
+
+        async def processSearchResponse(self, headers, addr=None):
+
+            # Each LOCATION is only fetched once.  A failed fetch is forgotten so the next search tries it again.
+            location=headers.get('location')
+            if not location or location in self.discovered:
+                return
+            self.discovered[location]=None
+            try:
+                entry=await self.getDescription(location)
+                if not entry:
+                    del self.discovered[location]
+                    return
+                self.discovered[location]=entry['address']
+                if entry['address'] in self.tv_addresses:
+                    return
+                self.log.info('.. discovered %s at %s:%s' % (entry.get('friendlyName'), entry['address'], entry['port']))
+                if not entry['preshared_key']:
+                    self.log.warning('.! no tv_preshared_key is configured, %s will only answer status requests' % entry['address'])
+                tv=await self.addTV(entry)
+                if tv:
+                    tv.poll_task=asyncio.ensure_future(self.pollTV(tv))
+                else:
+                    # a set that is still booting can fail to answer, so the next search tries it again
+                    self.discovered.pop(location, None)
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.error('!! Error adding discovered TV at %s' % location, exc_info=True)
+                self.discovered.pop(location, None)
+
+        async def getDescription(self, location):
+
+            try:
+                async with self.session.get(location, timeout=aiohttp.ClientTimeout(total=self.config.discovery_timeout)) as response:
+                    body=await response.read()
+                tree=et.fromstring(body)
+                fields={}
+                for element in tree.iter():
+                    name=element.tag.rsplit('}', 1)[-1]
+                    if name in ('friendlyName', 'modelName', 'X_ScalarWebAPI_BaseURL') and name not in fields:
+                        fields[name]=(element.text or '').strip()
+                if not fields.get('X_ScalarWebAPI_BaseURL'):
+                    return None
+                baseurl=urllib.parse.urlparse(fields['X_ScalarWebAPI_BaseURL'])
+                return {    'address': baseurl.hostname, 'port': baseurl.port or 80, 'preshared_key': self.config.tv_preshared_key or '',
+                            'friendlyName': fields.get('friendlyName', 'TV'), 'model': fields.get('modelName') }
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.log.error('!! Error reading device description %s' % location, exc_info=True)
+
+        def getMetrics(self):
+
+            try:
+                return {    'refresh_triggers': dict(self.refresh_triggers), 'suppressed_updates': self.suppressed_updates,
+                            'ingests_performed': self.ingests_performed, 'ingests_skipped': self.ingests_skipped, 'optimistic': dict(self.optimistic),
+                            'commands': dict(self.commands),
+                            'tvs': { name: tv.rest.metrics.dump() for name, tv in self.tvs.items() } }
+            except:
+                self.log.error('!! Error collecting metrics', exc_info=True)
+                return {}
+
+        async def dumpMetrics(self):
+            while True:
+                try:
+                    await asyncio.sleep(self.config.metrics_interval)
+                    self.log.info('.. metrics: %s' % json.dumps(self.getMetrics()))
+                except asyncio.CancelledError:
+                    break
+                except:
+                    self.log.error('!! Error dumping metrics', exc_info=True)
+
+        async def closeTV(self, tv):
+            if tv.notifications:
+                await tv.notifications.stop()
+            for task in [tv.command_task, tv.revalidate_task, tv.pending_update, tv.active_update, tv.poll_task, tv.waking]:
+                if task and not task.done():
+                    task.cancel()
+            await tv.rest.close()
+
+        async def stop(self):
+            try:
+                for task in [self.discovery_task, self.metrics_task]+self.retry_tasks:
+                    if task and not task.done():
+                        task.cancel()
+                for tv in self.tvs.values():
+                    await self.closeTV(tv)
+                for session in [self.session, self.notification_session]:
+                    if session is not None and not session.closed:
+                        await session.close()
+                if self.recorder:
+                    self.recorder.close()
+                    self.recorder=None
+            except:
+                self.log.error('!! Error closing TV connection', exc_info=True)
            
-        async def pollTV(self):
+        def pollInterval(self, tv, getter):
+            
+            interval=self.config.poll_intervals[getter]
+            if tv.rest.circuit_state!='closed':
+                # the power poll is the breaker's probe, sent as soon as the cool-down ends
+                return max(0.1, tv.rest.circuitRetry()) if getter=='PowerStatus' else interval
+            if tv.notifications and tv.notifications.pushed(getter):
+                # the TV pushes changes to this getter, so polling is only a slow health check
+                interval=max(interval, self.config.notification_health_interval)
+            elif self.loop.time()-tv.last_activity<self.config.poll_active_window:
+                interval=min(interval, self.config.poll_active_interval)
+            elif getter=='PowerStatus':
+                interval=min(interval*tv.poll_backoff, max(interval, self.config.poll_backoff_max))
+            return interval*(1+random.uniform(-self.config.poll_jitter, self.config.poll_jitter))
+
+        async def pollTV(self, tv):
+            
+            # Each getter has its own schedule.  While the TV is off or unreachable only the power status is polled
+            # and its interval backs off, and for a short window after a directive everything is polled quickly.
+            next_poll={}
+            for getter in self.config.poll_intervals:
+                if getter in self.update_getters:
+                    next_poll[getter]=self.loop.time()
+            if not next_poll:
+                self.log.warning('.! no known getters in poll_intervals, polling is disabled')
+                return
             while True:
                 try:
                     #self.log.info("Polling TV")
-                    sysinfo=await self.tv.getState('system','getPowerStatus')
-                    if sysinfo:
-                        await self.dataset.ingest({'tv':  { self.tvName: {'PowerStatus': sysinfo[0]}}})
-                    await asyncio.sleep(self.polltime)
+                    now=self.loop.time()
+                    due=[getter for getter in next_poll if next_poll[getter]<=now]
+                    if not tv.power_active:
+                        for getter in due:
+                            if getter!='PowerStatus':
+                                next_poll[getter]=now+self.pollInterval(tv, getter)
+                        due=[getter for getter in due if getter=='PowerStatus']
+                    if due:
+                        sysinfo=await self.getUpdate(tv, due, trigger='poll')
+                        if 'PowerStatus' in due:
+                            tv.poll_backoff=1 if tv.power_active else min(tv.poll_backoff*2, self.config.poll_backoff_max)
+                            if sysinfo and sysinfo.get('PowerStatus') and 'SystemInformation' not in self.snapshot.get(tv.name, {}):
+                                # the set did not answer at startup, and its device is only created once this arrives
+                                self.cacheTV(tv, await self.getInitialData(tv))
+                        for getter in due:
+                            next_poll[getter]=self.loop.time()+self.pollInterval(tv, getter)
+                    tv.poll_wakeup.clear()
+                    try:
+                        await asyncio.wait_for(tv.poll_wakeup.wait(), timeout=max(0.1, min(next_poll.values())-self.loop.time()))
+                        # a directive just ran, so pull every schedule in to the active interval
+                        for getter in next_poll:
+                            next_poll[getter]=min(next_poll[getter], self.loop.time()+self.pollInterval(tv, getter))
+                    except asyncio.TimeoutError:
+                        pass
+                except asyncio.CancelledError:
+                    break
                 except:
-                    self.log.error('Error fetching TV Data', exc_info=True)
+                    self.log.error('Error fetching TV Data for %s' % tv.name, exc_info=True)
+                    await asyncio.sleep(self.config.poll_intervals.get('PowerStatus', 5))
 
 
         async def addSmartDevice(self, path):
@@ -541,7 +1994,8 @@ class sonybravia(sofabase):
                 endpointId="%s:%s:%s" % ("sonybravia", device_type, device_id)
                 if endpointId not in self.dataset.localDevices:  # localDevices/friendlyNam                
                     if device_type=="tv":
-                        return self.addSmartTV(device_id, nativeObject, "TV")
+                        name=self.tvs[device_id].friendlyName if device_id in self.tvs else "TV"
+                        return self.addSmartTV(device_id, nativeObject, name)
             except:
                 self.log.error('Error defining smart device', exc_info=True)
             return False
@@ -554,7 +2008,7 @@ class sonybravia(sofabase):
                                                     manufacturerName="Sony", modelName=nativeObject['SystemInformation']['model'])
                     device.PowerController=sonybravia.PowerController(device=device)
                     device.EndpointHealth=sonybravia.EndpointHealth(device=device)
-                    device.InputController=sonybravia.InputController(device=device, inputs=self.input_list)
+                    device.InputController=sonybravia.InputController(device=device, inputs=self.tvs[device_id].input_list)
                     device.RemoteController=sonybravia.RemoteController(device=device)
                     device.SpeakerController=sonybravia.SpeakerController(device=device)
                     # On the XBR-75X850C that this was built for, there are only two actual supported modes: audioSystem and speaker
@@ -572,13 +2026,29 @@ class sonybravia(sofabase):
             except:
                 self.log.error('!! Error adding smart TV', exc_info=True)
             
-        def findRemoteCode(self, codename):
+        def remoteKey(self, codename):
+            return ''.join(char for char in codename.lower() if char.isalnum())
 
+        def buildRemoteIndex(self, tv, codes):
+
+            # Rebuilt only when getRemoteControllerInfo returns a different list, so lookups are a dict hit
             try:
-                for code in self.dataset.nativeDevices['tv']['BRAVIA']['remoteCommands']:
-                    if code['name']==codename:
-                        #self.log.info('Found code for %s: %s' % (codename, code['value']))
-                        return code['value']
+                index={}
+                for code in codes:
+                    index[self.remoteKey(code['name'])]=code['value']
+                tv.remote_codes=index
+            except:
+                self.log.error('Error indexing remote codes', exc_info=True)
+
+        def findRemoteCode(self, tv, codename):
+
+            try:
+                key=self.remoteKey(codename)
+                if key in tv.remote_codes:
+                    #self.log.info('Found code for %s: %s' % (codename, tv.remote_codes[key]))
+                    return tv.remote_codes[key]
+                if key in self.remote_aliases and self.remote_aliases[key] in tv.remote_codes:
+                    return tv.remote_codes[self.remote_aliases[key]]
                 self.log.info('No code found for %s' % codename)
                 return ''
             except:
@@ -587,6 +2057,10 @@ class sonybravia(sofabase):
 
         def getDetailsFromURI(self, uri):
             
+            # The input property reads the same few URIs on every state report, so parsed results are kept in a
+            # small cache and shared.  Callers must not change the returned dict.
+            if uri in self.uri_cache:
+                return self.uri_cache[uri]
             try:
                 result={}
                 conninfo=uri.split('?')[0]
@@ -598,24 +2072,28 @@ class sonybravia(sofabase):
                 for detail in details:
                     dparts=detail.split('=')
                     result[dparts[0]]=dparts[1]
-                    
+                
+                if len(self.uri_cache)>=self.uri_cache_size:
+                    del self.uri_cache[next(iter(self.uri_cache))]
+                self.uri_cache[uri]=result
                 return result
             except:
                 self.log.error('Error parsing input URI: %s' % uri, exc_info=True)
                 
 
-        def parse_input_name(self,nativeObj):
+        def parse_input_name(self,nativeObj, tv=None):
             
             try:
+                hdmi_port_names=tv.hdmi_port_names if tv else self.config.hdmi_port_names
                 if 'PlayingContentInfo' not in nativeObj:
                     #self.log.warn('No playing content')
                     return 'Android TV'
 
                 if 'uri' in nativeObj['PlayingContentInfo']:
                     details=self.getDetailsFromURI(nativeObj['PlayingContentInfo']['uri'])
-                    if nativeObj['PlayingContentInfo']['uri'].startswith('extInput:cec') or details['type'] in ['cec','hdmi','player']:
-                        if details['port'] in self.config.hdmi_port_names:
-                            return self.config.hdmi_port_names[details['port']]
+                    if details['type'] in self.port_input_types or nativeObj['PlayingContentInfo']['uri'].startswith('extInput:cec'):
+                        if details['port'] in hdmi_port_names:
+                            return hdmi_port_names[details['port']]
                 if 'title' in nativeObj['PlayingContentInfo']:
                     return nativeObj['PlayingContentInfo']['title']
                 else:
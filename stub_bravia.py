@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+# A local stand-in for a Sony Bravia TV, used to exercise and benchmark the adapter without a real set.
+# It answers the Sony JSON-RPC endpoints (system, audio, avContent, appControl) and the IRCC SOAP endpoint,
+# with configurable latency and injected errors, serves a UPnP device description, can build or send SSDP NOTIFY
+# packets and can answer M-SEARCH requests.
+
+import asyncio
+import json
+import random
+import socket
+import argparse
+from aiohttp import web
+
+
+class stub_bravia():
+
+    def __init__(self, host='127.0.0.1', port=0, name='BRAVIA', latency=0.0, jitter=0.0, errors={}, error_rate=0.0, batch=True, apps=50, codes=100, notify=True, wake_time=0.0):
+        self.host=host
+        self.port=port
+        self.name=name
+        self.latency=latency
+        self.jitter=jitter
+        # errors maps a method name to the error text it should always return, error_rate randomly fails
+        # that fraction of the remaining calls with "Illegal State"
+        self.errors=errors
+        self.error_rate=error_rate
+        self.batch=batch
+        # wake_time is how long a set that is switched on keeps answering as if it were off
+        self.wake_time=wake_time
+        self.waking=None
+        self.runner=None
+        self.search_transport=None
+        self.searches=0
+        # notify sets the methods a WebSocket subscriber can enable, empty makes the endpoint behave like old firmware
+        self.notify_methods={ 'system': ['notifyPowerStatus'], 'audio': ['notifyVolumeInformation'], 'avContent': ['notifyPlayingContentInfo'] } if notify else {}
+        self.subscribers={}
+        self.requests=0
+        self.ircc_requests=0
+        self.state={   'power': 'active', 'powerSavingMode': 'off', 'volume': 20, 'mute': False, 'outputTerminal': 'speaker',
+                        'uri': 'extInput:hdmi?port=1', 'title': 'HDMI 1' }
+        self.applications=[{ 'title': 'App %s' % i, 'uri': 'com.sony.dtv.app%s' % i, 'icon': 'http://%s/icons/app%s.png' % (host, i), 'data': '' } for i in range(apps)]
+        self.remote_codes=[{ 'name': name, 'value': 'AAAAAQAAAAEAAAA%sAw==' % i } for i, name in enumerate(['Home', 'VolumeUp', 'VolumeDown', 'Mute', 'Confirm', 'Return',
+                                                                                                                    'Up', 'Down', 'Left', 'Right', 'ChannelUp', 'ChannelDown', 'TvPower'])]
+        for i in range(len(self.remote_codes), codes):
+            self.remote_codes.append({ 'name': 'Button%s' % i, 'value': 'AAAAAgAAAJcAAAA%sAw==' % i })
+
+    @property
+    def address(self):
+        return "%s:%s" % (self.host, self.port)
+
+    async def start(self):
+        app=web.Application()
+        app.router.add_get('/dmr.xml', self.handleDescription)
+        app.router.add_post('/sony/IRCC', self.handleIRCC)
+        app.router.add_post('/sony/{service}', self.handleJSON)
+        app.router.add_get('/sony/{service}', self.handleSocket)
+        self.runner=web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site=web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port=self.runner.addresses[0][1]
+        return self
+
+    async def stop(self):
+        if self.waking:
+            self.waking.cancel()
+            self.waking=None
+        if self.search_transport:
+            self.search_transport.close()
+            self.search_transport=None
+        for ws in list(self.subscribers):
+            await ws.close()
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner=None
+
+    async def delay(self):
+        if self.latency or self.jitter:
+            await asyncio.sleep(max(0, self.latency+random.uniform(0, self.jitter)))
+
+    def error(self, command, code, message):
+        return { 'id': command.get('id'), 'error': [code, message] }
+
+    def answer(self, service, command):
+
+        method=command.get('method', '')
+        params=command.get('params', [])
+        params=params[0] if params else {}
+
+        if method in self.errors:
+            return self.error(command, 40005 if 'Display' in self.errors[method] else 7, self.errors[method])
+        if self.error_rate and random.random()<self.error_rate:
+            return self.error(command, 7, 'Illegal State')
+        if self.state['power']!='active' and service in ['audio', 'avContent'] and not method.startswith('set'):
+            return self.error(command, 40005, 'Display Is Turned off')
+
+        if method=='getSystemInformation':
+            result=[{ 'product': 'TV', 'name': self.name, 'model': 'XBR-75X850C', 'serial': '%s-%s' % (self.name, self.port),
+                        'macAddr': '02:00:00:00:%02x:%02x' % (self.port//256%256, self.port%256), 'generation': '5.2.0' }]
+        elif method=='getRemoteControllerInfo':
+            result=[{ 'bundled': True, 'type': 'RM-J1100' }, self.remote_codes]
+        elif method=='getApplicationList':
+            result=[self.applications]
+        elif method=='getPowerStatus':
+            result=[{ 'status': self.state['power'] }]
+        elif method=='setPowerStatus':
+            if self.waking:
+                self.waking.cancel()
+                self.waking=None
+            if params.get('status') and self.state['power']!='active' and self.wake_time:
+                self.waking=asyncio.get_event_loop().call_later(self.wake_time, self.powerOn)
+            else:
+                self.state['power']='active' if params.get('status') else 'standby'
+                self.push('system', 'notifyPowerStatus', { 'status': self.state['power'] })
+            result=[]
+        elif method=='getPowerSavingMode':
+            result=[{ 'mode': self.state['powerSavingMode'] }]
+        elif method=='setPowerSavingMode':
+            self.state['powerSavingMode']=params.get('mode', 'off')
+            result=[]
+        elif method=='getVolumeInformation':
+            result=[[{ 'target': 'speaker', 'volume': self.state['volume'], 'mute': self.state['mute'], 'maxVolume': 100, 'minVolume': 0 }]]
+        elif method=='setAudioVolume':
+            self.state['volume']=int(params.get('volume', self.state['volume']))
+            self.push('audio', 'notifyVolumeInformation', { 'target': 'speaker', 'volume': self.state['volume'], 'mute': self.state['mute'] })
+            result=[0]
+        elif method=='getSoundSettings':
+            result=[[{ 'target': 'outputTerminal', 'currentValue': self.state['outputTerminal'] }]]
+        elif method=='setSoundSettings':
+            for setting in params.get('settings', []):
+                if setting.get('target')=='outputTerminal':
+                    self.state['outputTerminal']=setting['value']
+            result=[]
+        elif method=='getPlayingContentInfo':
+            result=[{ 'uri': self.state['uri'], 'source': 'extInput:hdmi', 'title': self.state['title'] }]
+        elif method=='setPlayContent':
+            self.state['uri']=params.get('uri', self.state['uri'])
+            self.state['title']='HDMI %s' % self.state['uri'].split('port=')[-1]
+            self.push('avContent', 'notifyPlayingContentInfo', { 'uri': self.state['uri'], 'source': 'extInput:hdmi', 'title': self.state['title'] })
+            result=[]
+        elif method=='getCurrentExternalInputsStatus':
+            result=[[{ 'uri': 'extInput:hdmi?port=%s' % i, 'title': 'HDMI %s' % i, 'connection': True, 'label': '', 'icon': 'meta:hdmi' } for i in range(1, 5)]]
+        else:
+            return self.error(command, 12, 'No Such Method')
+        return { 'id': command.get('id'), 'result': result }
+
+    def powerOn(self):
+        self.waking=None
+        self.state['power']='active'
+        self.push('system', 'notifyPowerStatus', { 'status': self.state['power'] })
+
+    async def handleJSON(self, request):
+        await self.delay()
+        self.requests+=1
+        service=request.match_info['service']
+        body=json.loads(await request.read())
+        if isinstance(body, list):
+            if not self.batch:
+                return web.json_response({ 'id': None, 'error': [12, 'Unsupported'] })
+            return web.json_response([self.answer(service, command) for command in body])
+        return web.json_response(self.answer(service, body))
+
+    async def handleSocket(self, request):
+        service=request.match_info['service']
+        if service not in self.notify_methods:
+            return web.Response(status=404)
+        ws=web.WebSocketResponse()
+        await ws.prepare(request)
+        enabled=[]
+        self.subscribers[ws]=(service, enabled)
+        try:
+            async for message in ws:
+                if message.type!=web.WSMsgType.TEXT:
+                    continue
+                command=json.loads(message.data)
+                if command.get('method')!='switchNotifications':
+                    await ws.send_json(self.error(command, 12, 'No Such Method'))
+                    continue
+                params=command.get('params', [{}])[0]
+                for item in params.get('enabled', []):
+                    if item['name'] in self.notify_methods[service] and item['name'] not in enabled:
+                        enabled.append(item['name'])
+                for item in params.get('disabled', []):
+                    if item['name'] in enabled:
+                        enabled.remove(item['name'])
+                await ws.send_json({ 'id': command.get('id'), 'result': [{  'enabled': [{ 'name': name, 'version': '1.0' } for name in enabled],
+                                                                            'disabled': [{ 'name': name, 'version': '1.0' } for name in self.notify_methods[service] if name not in enabled] }] })
+        finally:
+            del self.subscribers[ws]
+        return ws
+
+    def push(self, service, method, params):
+        for ws, (subscribed, enabled) in list(self.subscribers.items()):
+            if subscribed==service and method in enabled:
+                asyncio.ensure_future(ws.send_json({ 'method': method, 'params': [params], 'version': '1.0' }))
+
+    async def handleIRCC(self, request):
+        await self.delay()
+        self.ircc_requests+=1
+        await request.read()
+        return web.Response(text='<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/"><s:Body><u:X_SendIRCCResponse xmlns:u="urn:schemas-sony-com:service:IRCC:1"></u:X_SendIRCCResponse></s:Body></s:Envelope>',
+                                content_type='text/xml')
+
+    def notify(self, nts='ssdp:alive'):
+        return ('NOTIFY * HTTP/1.1\r\n'
+                'HOST: 239.255.255.250:1900\r\n'
+                'CACHE-CONTROL: max-age=1800\r\n'
+                'LOCATION: http://%s:%s/dmr.xml\r\n'
+                'NT: upnp:rootdevice\r\n'
+                'NTS: %s\r\n'
+                'SERVER: Android/8.0 UPnP/1.0 BRAVIA/1.0\r\n'
+                'USN: uuid:00000000-0000-1010-8000-%012x::upnp:rootdevice\r\n'
+                '\r\n' % (self.host, self.port, nts, self.port)).encode()
+
+    def searchResponse(self, st='urn:schemas-sony-com:service:ScalarWebAPI:1'):
+        return ('HTTP/1.1 200 OK\r\n'
+                'CACHE-CONTROL: max-age=1800\r\n'
+                'EXT:\r\n'
+                'LOCATION: http://%s:%s/dmr.xml\r\n'
+                'SERVER: Android/8.0 UPnP/1.0 BRAVIA/1.0\r\n'
+                'ST: %s\r\n'
+                'USN: uuid:00000000-0000-1010-8000-%012x::%s\r\n'
+                '\r\n' % (self.host, self.port, st, self.port, st)).encode()
+
+    async def handleDescription(self, request):
+        await self.delay()
+        return web.Response(text='<?xml version="1.0"?><root xmlns="urn:schemas-upnp-org:device-1-0" xmlns:av="urn:schemas-sony-com:av"><device>'
+                                    '<deviceType>urn:schemas-upnp-org:device:MediaRenderer:1</deviceType><friendlyName>%s</friendlyName>'
+                                    '<manufacturer>Sony Corporation</manufacturer><modelName>XBR-75X850C</modelName>'
+                                    '<av:X_ScalarWebAPI_DeviceInfo><av:X_ScalarWebAPI_Version>1.0</av:X_ScalarWebAPI_Version>'
+                                    '<av:X_ScalarWebAPI_BaseURL>http://%s:%s/sony</av:X_ScalarWebAPI_BaseURL></av:X_ScalarWebAPI_DeviceInfo>'
+                                    '</device></root>' % (self.name, self.host, self.port), content_type='text/xml')
+
+    async def answerSearches(self, port=0):
+
+        # answers M-SEARCH requests for the ScalarWebAPI or ssdp:all on a UDP port of its own and returns that port
+        stub=self
+        class responder(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport=transport
+            def datagram_received(self, data, addr):
+                if data.startswith(b'M-SEARCH') and (b'ScalarWebAPI' in data or b'ssdp:all' in data):
+                    stub.searches+=1
+                    self.transport.sendto(stub.searchResponse(), addr)
+        self.search_transport, protocol=await asyncio.get_running_loop().create_datagram_endpoint(responder, local_addr=(self.host, port))
+        return self.search_transport.get_extra_info('sockname')[1]
+
+    def sendNotify(self, count=1, target=('239.255.255.250', 1900)):
+        sock=socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+            for i in range(count):
+                sock.sendto(self.notify(), target)
+        finally:
+            sock.close()
+
+
+async def serve(args):
+    tvs=[]
+    for i in range(args.tvs):
+        tv=stub_bravia(host=args.host, port=args.port+i if args.port else 0, name='BRAVIA%s' % i if args.tvs>1 else 'BRAVIA', latency=args.latency,
+                        jitter=args.jitter, error_rate=args.error_rate, batch=not args.no_batch)
+        tvs.append(await tv.start())
+        print('stub bravia %s listening on %s' % (tv.name, tv.address))
+    try:
+        while True:
+            await asyncio.sleep(args.notify or 3600)
+            if args.notify:
+                for tv in tvs:
+                    tv.sendNotify()
+    finally:
+        for tv in tvs:
+            await tv.stop()
+
+if __name__ == '__main__':
+    parser=argparse.ArgumentParser(description='Local stand-in for a Sony Bravia TV')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--tvs', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=0.03, help='seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--no-batch', action='store_true', help='reject JSON-RPC batches like older firmware')
+    parser.add_argument('--notify', type=float, default=0, help='send an SSDP NOTIFY every n seconds')
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass